@@ -0,0 +1,103 @@
+import math
+
+from typing import Iterable, Optional
+
+
+# Агрегат одного показателя по группе тикеров: число не-None значений, сумма и сумма квадратов.
+# Добавление, удаление и замена тикера - O(1), среднее всегда точное.
+# 'avg' хранится округлённым рядом для отчёта и относительного рейтинга
+
+
+def new_stat() -> dict:
+    return {'count': 0, 'sum': 0.0, 'sumsq': 0.0, 'avg': None}
+
+
+def is_exact(group: dict) -> bool:
+    # Старые файлы хранят пары acc/avg, их нужно пересобрать по тикерам
+    return 'sum' in group.get('base_rate', {})
+
+
+def update_avg(stat: dict) -> None:
+    stat['avg'] = round(stat['sum'] / stat['count'], 2) if stat['count'] > 0 else None
+
+
+def add_value(stat: dict, value: Optional[float]) -> None:
+    if value is not None:
+        stat['count'] += 1
+        stat['sum'] += value
+        stat['sumsq'] += value * value
+    update_avg(stat)
+
+
+def remove_value(stat: dict, value: Optional[float]) -> None:
+    if value is not None:
+        stat['count'] -= 1
+        stat['sum'] -= value
+        stat['sumsq'] -= value * value
+        if stat['count'] == 0:
+            # Без остатка от накопленной погрешности
+            stat['sum'] = stat['sumsq'] = 0.0
+    update_avg(stat)
+
+
+def replace_value(stat: dict, old: Optional[float], new: Optional[float]) -> None:
+    remove_value(stat, old)
+    add_value(stat, new)
+
+
+def std(stat: dict) -> Optional[float]:
+    if stat['count'] < 2:
+        return None
+    mean = stat['sum'] / stat['count']
+    return math.sqrt(max(stat['sumsq'] / stat['count'] - mean * mean, 0.0))
+
+
+def ticker_values(ticker: dict) -> dict[str, Optional[float]]:
+    return {'base_rate': ticker['base_rate'], **ticker['indicators']}
+
+
+def stats_of(group: dict) -> dict[str, dict]:
+    return {'base_rate': group['base_rate'], **group['indicators']}
+
+
+def add_ticker(group: dict, ticker: dict) -> None:
+    stats = stats_of(group)
+    for name, value in ticker_values(ticker).items():
+        if name not in stats:
+            group['indicators'][name] = stats[name] = new_stat()
+        add_value(stats[name], value)
+
+
+def remove_ticker(group: dict, ticker: dict) -> None:
+    stats = stats_of(group)
+    for name, value in ticker_values(ticker).items():
+        if name in stats:
+            remove_value(stats[name], value)
+
+
+def replace_ticker(group: dict, old: dict, new: dict) -> None:
+    remove_ticker(group, old)
+    add_ticker(group, new)
+
+
+def rebuild(tickers: Iterable[dict]) -> dict:
+    # Полный пересчёт base_rate и indicators группы по её тикерам
+    group = {'base_rate': new_stat(), 'indicators': {}}
+    for ticker in tickers:
+        add_ticker(group, ticker)
+    return group
+
+
+def verify(group: dict, tickers: Iterable[dict], tolerance: float = 1e-6) -> list[str]:
+    # Сравнивает инкрементальный агрегат с пересчитанным заново, возвращает расхождения
+    exact = stats_of(rebuild(tickers))
+    stats = stats_of(group) if is_exact(group) else {}
+    diffs = []
+    for name in sorted(set(exact) | set(stats)):
+        if name not in stats or name not in exact:
+            diffs.append(f'{name}: missing')
+            continue
+        for key in ('count', 'sum', 'sumsq'):
+            if abs(stats[name][key] - exact[name][key]) > tolerance * max(1.0, abs(exact[name][key])):
+                diffs.append(f'{name}.{key}: {stats[name][key]} != {exact[name][key]}')
+    return diffs
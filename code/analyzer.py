@@ -1,13 +1,27 @@
+import copy
 import json
-import matplotlib.pyplot as plt
+import threading
 import time
 
+from collections import OrderedDict
 from enum import Enum
-from os import path, mkdir
-from matplotlib import dates, ticker as tckr
+from functools import cached_property
 from typing import Optional, Union
 
+import numpy as np
+
+import aggregate
+import charts
+import dcf
+import filings
 import network
+import peers
+import prices
+import reports
+import storage
+import templates
+from dcf import get_growth
+from flight import SingleFlight
 
 
 class DataType(Enum):
@@ -23,16 +37,126 @@ class DataType(Enum):
     RATING = 9
 
 
-def get_growth(_from: float, _to: float) -> float:
-    if (_from != 0.0) & (None not in [_from, _to]):
-        dif = _to - _from
-        return dif / abs(_from)
+# Одновременные запросы одного тикера ждут одну сборку Company и один рендер графика
+company_flight = SingleFlight()
+chart_flight = SingleFlight()
+
+
+def get_company(ticker: str, bot_version: str, is_yoy: int = 0) -> 'Company':
+    # is_yoy на сборку не влияет: ключ только тикер, чтобы разные настройки dynamics не оценивали его параллельно
+    return company_flight.do(ticker, Company, ticker, bot_version, is_yoy)
+
+
+def get_view(ticker: str, bot_version: str) -> Optional['CompanyView']:
+    # Готовый тикер, про который календарь отчётов знает, что он свеж, читается без сети и без записей.
+    # None - нужна полная Company (новый тикер, старая версия бота, новый отчёт или календарь не знает)
+    meta = storage.store.get_meta(ticker)
+    if meta is None or bot_version > meta['version']:
+        return None
+    if filings.calendar.is_stale(ticker, meta['lastUpdate']) is not False:
+        return None
+    return CompanyView(ticker, meta)
+
+
+def generate_chart(ticker: str, name: str, days: int = 365) -> str:
+    # -> ключ графика в charts.cache; Company не нужна, поэтому годится и для отчёта из reports.cache
+    return chart_flight.do((ticker, days), render_chart, ticker, name, days)
+
+
+def render_chart(ticker: str, name: str, days: int) -> str:
+    trading_date = charts.last_trading_date()
+    key = charts.chart_key(ticker, days, trading_date)
+    if charts.cache.get(key) is not None:
+        return key
+
+    window = prices.store.window(ticker, days)
+    last_date = str(window['day'][-1].astype('datetime64[D]')) if len(window) else trading_date
+    if last_date < trading_date:
+        # Закрытия последней сессии ещё нет: график помечается днём, по который есть данные,
+        # чтобы с появлением закрытия ключ сменился и график перерисовался
+        key = charts.chart_key(ticker, days, last_date)
+        if charts.cache.get(key) is not None:
+            return key
+    charts.renderer.render(charts.cache.path(key), f'{ticker}, {name}', window['day'], np.round(window['close'], 2))
+    charts.cache.put(key, ticker, days)
+    return key
+
+
+def dcf_grid(ticker: dict) -> Optional[dict]:
+    # Сетка и Монте-Карло считаются только для отчёта, где блок включён, по сохранённым входам DCF.
+    # У тикеров, оценённых до появления dcf_inputs, берётся то, что было посчитано при оценке
+    inputs = ticker.get('dcf_inputs')
+    return dcf.sensitivity(inputs) if inputs is not None else ticker.get('dcf_grid')
+
+
+def dcf_distribution(ticker: dict) -> Optional[dict]:
+    # mc_samples = 0 выключает расчёт
+    inputs = ticker.get('dcf_inputs')
+    if inputs is None:
+        return ticker.get('dcf_mc')
+    return dcf.monte_carlo_cached(ticker['ticker'], inputs) if dcf.mc_samples > 0 else None
+
+
+# Шаблоны отчёта, скомпилированные под пару (язык, настройки отчёта пользователя)
+max_report_plans: int = 256
+report_plans: OrderedDict = OrderedDict()
+report_plans_lock = threading.Lock()
+# Строки новых блоков отчёта, пока их нет в language.json
+report_text: dict = dict(en=dict(mc='DCF P5 / P50 / P95: _ / __ / ___ $\n', grid='DCF: WACC \\ g',
+                                 percentile='    percentile _ among _ peers\n'),
+                         ru=dict(mc='DCF, разброс P5 / P50 / P95: _ / __ / ___ $\n', grid='DCF: WACC \\ рост',
+                                 percentile='    перцентиль _ среди _ компаний\n'))
+
+
+def compile_report(lang_dict: dict, report_config: dict, language: str = 'en') -> dict:
+    compile_template = templates.compile_template
+    text = report_text.get(language, report_text['en'])
+    signs = ('_', '__', '___')
+    dynamics = ((2, lang_dict['dynamics'][report_config['dynamics']]),)
+    value_dict = lang_dict['value']
+    compare_type = report_config['value_type']
+    if compare_type in (0, 1):
+        value_line = value_dict['template']
+        value_fixed = lambda label: ((0, label), (3, value_dict['value_type'][compare_type]))
+        value_signs = ('_',) * 5
     else:
-        return 0.0
+        value_line = value_dict['template'][:5] + '\n' if compare_type == 2 else value_dict['template']
+        value_fixed = lambda label: ((0, label),)
+        value_signs = ('_',) * 2
+    return {
+        'beta': compile_template(lang_dict['beta'], ('_',)),
+        'rate': compile_template(lang_dict['rate'], ('_', '__'), ((1, str(10.0)),)),
+        'finance': [compile_template(line, signs, dynamics) for line in lang_dict['finance']['data']],
+        'balance': [compile_template(line, signs, dynamics) for line in lang_dict['balance']['data']],
+        'div_yield': compile_template(lang_dict['div']['yield'], signs, dynamics),
+        'value': [compile_template(value_line, value_signs, value_fixed(label)) for label in value_dict['data']],
+        'percentile': compile_template(value_dict.get('percentile', text['percentile']), ('_',) * 2),
+        'dcf': compile_template(lang_dict['dcf']['base_line'], ('_',)),
+        'dcf_none': compile_template(lang_dict['dcf']['base_line'], ('_',), ((0, lang_dict['dcf']['no_data']),)),
+        'mc': compile_template(lang_dict['dcf'].get('mc', text['mc']), signs),
+        'grid': compile_template(lang_dict['dcf'].get('grid', text['grid']), ())
+    }
+
+
+def report_plan(lang_dict: dict, report_config: dict, language: str = 'en') -> dict:
+    # lang_dict загружается один раз при старте, поэтому ключ - его id (и проверка, что это тот же объект)
+    key = (id(lang_dict), language, tuple((name, tuple(value) if isinstance(value, list) else value)
+                                for name, value in report_config.items()))
+    with report_plans_lock:
+        entry = report_plans.get(key)
+        if entry is not None and entry[0] is lang_dict:
+            report_plans.move_to_end(key)
+            return entry[1]
+    plan = compile_report(lang_dict, report_config, language)
+    with report_plans_lock:
+        report_plans[key] = (lang_dict, plan)
+        while len(report_plans) > max_report_plans:
+            report_plans.popitem(last=False)
+    return plan
 
 
 class Company:
-    data_path: str = '\\FinancialData/'
+    data_path: str = storage.data_path
     countries: dict = json.load(open(f'{data_path}countries.json'))
 
     def __init__(self, _ticker, bot_version: str, _is_yoy: int = 0):
@@ -47,25 +171,20 @@ class Company:
         self.industry_str = str()
         self.sector = dict()
         self.sector_str = str()
-        self.ticker_path = str()
-        self.industry_path = str()
-        self.sector_path = str()
-        self.all_tickers = dict()
+        self.meta: Optional[dict] = None
+        self.dcf_inputs: Optional[dict] = None
+        # Версия данных, из которых собран отчёт (см. reports.cache)
+        self.report_version: Optional[tuple] = None
         self.is_yoy = True if _is_yoy == 0 else False
 
         self.is_new_ticker, is_time_to_update = self.get_company_data()
-        if is_time_to_update or bot_version > self.all_tickers[self.ticker_str]['version']:
+        if is_time_to_update or bot_version > self.meta['version']:
             self.estimate_company()
         else:
             self.upload_data()
 
     def generate_report(self, config, lang_dict) -> str:
 
-        def build(base: str, add: list, sign: list) -> str:
-            for _add, _sign in zip(add, sign):
-                base = base.replace(_sign, str(_add), 1)
-            return base
-
         def to_lnum(input_num: float):
             patterns = ['', 'k', 'm', 'b']
             order = 0
@@ -77,25 +196,23 @@ class Company:
         def to_prc(num):
             return ('+' if num > 0.0 else '') + f'{str(round(num * 100, 2))}%' if num is not None else 'n/a'
 
-        report: str = f'{self.ticker["name"]}\n\n'
+        # Строки языка уже подставлены в шаблоны, здесь только числа; куски склеиваются одним join в конце
+        plan = report_plan(lang_dict, config['report'], config.get('language', 'en'))
+        report: list[str] = [f'{self.ticker["name"]}\n\n']
         config_o = config['report']['other']
-        dynamics = lang_dict['dynamics'][config['report']['dynamics']]
 
         key_s = self.ticker['key_statements']
+        key_dynamic = 'growth_yoy' if config['report']['dynamics'] == 0 else 'growth_qoq'
 
         # Beta
         if config_o[1]:
-            report += build(lang_dict['beta'], [str(self.ticker['beta'])], ['_'])
-            report += '\n'
+            report.append(plan['beta'].format(self.ticker['beta']))
+            report.append('\n')
 
         # Рейтинг
         if config_o[2]:
-            max_rate = str(10.0)
-            report += build(lang_dict['rate'],
-                            [str(self.ticker['base_rate']), max_rate],
-                            ['_', '__']
-                            )
-            report += '\n'
+            report.append(plan['rate'].format(self.ticker['base_rate']))
+            report.append('\n')
 
         # Финансы
         config_f: list = config['report']['finance']
@@ -105,16 +222,12 @@ class Company:
                 'netIncome',
                 'freeCashFlow'
             ]
-            report += lang_dict["finance"]["base_line"]
-            section_list = lang_dict["finance"]["data"]
-            key_dynamic = 'growth_yoy' if config["report"]["dynamics"] == 0 else 'growth_qoq'
+            report.append(lang_dict["finance"]["base_line"])
             for i in range(len(config_f)):
                 if config_f[i]:
-                    report += build(section_list[i],
-                                    [to_lnum(key_s[marks[i]]['raw']), to_prc(key_s[marks[i]][key_dynamic]), dynamics],
-                                    ['_', '__', '___']
-                                    )
-            report += '\n'
+                    report.append(plan['finance'][i].format(to_lnum(key_s[marks[i]]['raw']),
+                                                            to_prc(key_s[marks[i]][key_dynamic])))
+            report.append('\n')
 
         # Баланс
         config_b: list = config['report']['balance']
@@ -124,50 +237,31 @@ class Company:
                 "cashAndCashEquivalents",
                 "netDebt"
             ]
-            report += lang_dict['balance']['base_line']
-            section_list = lang_dict['balance']['data']
-            key_dynamic = 'growth_yoy' if config['report']['dynamics'] == 0 else 'growth_qoq'
+            report.append(lang_dict['balance']['base_line'])
             for i in range(len(config_b)):
                 if config_b[i]:
-                    report += build(section_list[i],
-                                    [to_lnum(key_s[marks[i]]['raw']), to_prc(key_s[marks[i]][key_dynamic]), dynamics],
-                                    # тут поменять марку
-                                    ['_', '__', '___']
-                                    )
-            report += '\n'
+                    report.append(plan['balance'][i].format(to_lnum(key_s[marks[i]]['raw']),
+                                                            to_prc(key_s[marks[i]][key_dynamic])))
+            report.append('\n')
 
         # Дивиденды
         config_d = config['report']['div']
         if True in config_d:
-            report += lang_dict['div']['base_line']
-            key_dynamic = 'growth_yoy' if config['report']['dynamics'] == 0 else 'growth_qoq'
+            report.append(lang_dict['div']['base_line'])
             if key_s['dividendYield']['raw'] is not None:
                 if config_d[0]:
-                    report += build(lang_dict['div']['yield'],
-                                    [
-                                        to_prc(key_s['dividendYield']['raw'])[1:],
-                                        to_prc(key_s['dividendYield'][key_dynamic]),
-                                        dynamics
-                                    ],
-                                    ['_', '__', '___']
-                                    )
+                    report.append(plan['div_yield'].format(to_prc(key_s['dividendYield']['raw'])[1:],
+                                                           to_prc(key_s['dividendYield'][key_dynamic])))
                 if config_d[1]:
-                    report += build(lang_dict['div']['yield'],
-                                    [
-                                        to_lnum(key_s['dividendYieldPerShare']['raw']),
-                                        to_prc(key_s['dividendYieldPerShare'][key_dynamic]),
-                                        dynamics
-                                    ],
-                                    ['_', '__', '___']
-                                    )
+                    report.append(plan['div_yield'].format(to_lnum(key_s['dividendYieldPerShare']['raw']),
+                                                           to_prc(key_s['dividendYieldPerShare'][key_dynamic])))
             else:
-                report += lang_dict['div']['none']
-            report += '\n'
+                report.append(lang_dict['div']['none'])
+            report.append('\n')
 
         config_v = config['report']['value']
         # Оценка
         if True in config_v:
-            local_dict: dict = lang_dict['value']
             marks = [
                 'peRatioTTM',
                 'pegRatioTTM',
@@ -175,245 +269,97 @@ class Company:
                 'priceToBookRatioTTM',
                 'priceToFreeCashFlowsRatioTTM'
             ]
-            report += local_dict['base_line']
-            templ_line: str = local_dict['template']
+            report.append(lang_dict['value']['base_line'])
             compare_type: int = config['report']['value_type']
             for i, item in enumerate(config_v):
                 if item:
-                    add_arr = [local_dict['data'][i], self.ticker['indicators'][marks[i]]]
-                    filler_arr = ['_'] * 2
-                    if compare_type == 0:
-                        add_arr.extend([self.industry['indicators'][marks[i]]['avg'],
-                                        local_dict['value_type'][config['report']['value_type']],
-                                        self.industry['tickers']['count']])
-                        filler_arr.extend(['_'] * 3)
-                    elif compare_type == 1:
-                        add_arr.extend([self.sector['indicators'][marks[i]]['avg'],
-                                        local_dict['value_type'][config['report']['value_type']],
-                                        self.sector['tickers']['count']])
-                        filler_arr.extend(['_'] * 3)
-                    elif compare_type == 2:
-                        templ_line = templ_line[:5] + '\n'
-                    report += build(templ_line, add_arr, filler_arr)
-            report += '\n'
+                    # Подпись показателя и тип сравнения уже в шаблоне, на их местах None
+                    if compare_type in (0, 1):
+                        group = self.industry if compare_type == 0 else self.sector
+                        report.append(plan['value'][i].format(None, self.ticker['indicators'][marks[i]],
+                                                              group['indicators'][marks[i]]['avg'], None,
+                                                              group['tickers']['count']))
+                        # Место среди пиров той же группы, с которой сравниваем, если включено в настройках
+                        if len(config_o) > 5 and config_o[5]:
+                            rank = peers.matrix.load().percentile_rank(self.ticker_str, marks[i],
+                                                                       'industry' if compare_type == 0 else 'sector')
+                            if rank is not None:
+                                report.append(plan['percentile'].format(*rank))
+                    else:
+                        report.append(plan['value'][i].format(None, self.ticker['indicators'][marks[i]]))
+            report.append('\n')
 
         # DCF
         if config_o[0]:
-            add_line = f'{str(round(self.ticker["dcf"], 2))} $' \
-                if self.ticker["dcf"] is not None else lang_dict['dcf']['no_data']
-            report += build(lang_dict['dcf']['base_line'], [add_line], ['_'])
-
-        return report
-
-    def generate_chart(self) -> str:
-        plot_path = f'{self.data_path}Plots/{self.ticker_str}.png'
-
-        if path.exists(plot_path):  # работает только для дневок
-            last_plt_upd = time.gmtime(path.getmtime(plot_path))
-            time_now = time.gmtime()
-            if (last_plt_upd.tm_year == time_now.tm_year) & \
-                    (last_plt_upd.tm_mon == time_now.tm_mon) & \
-                    (
-                            (last_plt_upd.tm_wday == time_now.tm_wday) |
-                            ((time_now.tm_wday in (0, 1)) & (last_plt_upd.tm_wday in (6, 0)))
-                    ):
-                return plot_path
-
-        chart = network.get_chart(self.ticker_str, 365)
-        date_list = []
-        data_list = []
-        for elem in reversed(chart):
-            data_list.append(round(elem["close"], 2))
-            date_list.append(dates.datestr2num(elem["date"]))
-
-        fig, ax = plt.subplots(figsize=(10, 6), dpi=100)
-        ax.set_title(f'{self.ticker["ticker"]}, {self.ticker["name"]}', loc='left', y=0.9, x=0.01,
-                     fontsize=20, backgroundcolor='white')
-        # X-axis
-        ax.xaxis.set_major_formatter(dates.DateFormatter("%b '%y"))
-        ax.xaxis.set_major_locator(dates.MonthLocator())
-        # ax.xaxis.set_minor_formatter(dates.DateFormatter("%b"))
-        # ax.xaxis.set_minor_locator(matplotlib.dates.MonthLocator())
-        # Y-axis
-        order = (str(round(max(data_list))).__len__() - 2)
-        if order == 0:
-            order = 1
-        ax.yaxis.set_major_locator(tckr.MultipleLocator(10 ** order))
-        ax.yaxis.set_minor_locator(tckr.MultipleLocator((10 ** order) / 2))
-
-        ax.plot(date_list, data_list)
-        plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
-        ax.axhline(data_list[-1], color='gray', linestyle='--', linewidth=0.6)
-        ax.text(date_list[-1] + 30, data_list[-1], str(data_list[-1]), size=10,
-                ha="center", va="center",
-                bbox=dict(boxstyle="round",
-                          facecolor='white'
-                          )
-                )
-        ax.spines["top"].set_visible(False)
-        ax.spines["left"].set_visible(False)
-        ax.yaxis.tick_right()
-        # plt.grid()
-
-        fig.savefig(plot_path, bbox_inches='tight')
-        fig.clf()
-        return plot_path
+            if self.ticker["dcf"] is not None:
+                report.append(plan['dcf'].format(f'{str(round(self.ticker["dcf"], 2))} $'))
+            else:
+                report.append(plan['dcf_none'].format())
+
+        # Разброс справедливой цены по Монте-Карло
+        dcf_mc = dcf_distribution(self.ticker) if len(config_o) > 4 and config_o[4] else None
+        if dcf_mc:
+            bands = dcf_mc['percentiles']
+            report.append(plan['mc'].format(bands['5'], bands['50'], bands['95']))
+
+        # Чувствительность DCF к WACC и темпу роста
+        grid = dcf_grid(self.ticker) if len(config_o) > 3 and config_o[3] else None
+        if grid:
+            report.append('\n' + plan['grid'].format() + '\n')
+            report.append(' ' * 7 + ''.join(f'{g * 100:>8.1f}%' for g in grid['growth']) + '\n')
+            for wacc, row in zip(grid['wacc'], grid['price']):
+                report.append(f'{wacc * 100:>6.1f}%' +
+                              ''.join(f'{cell:>9.2f}' if cell is not None else f'{"n/a":>9}' for cell in row) + '\n')
+
+        return ''.join(report)
+
+    def generate_chart(self, days: int = 365) -> str:
+        return generate_chart(self.ticker_str, self.ticker['name'], days)
 
     def prepare_data(self):
-        if not path.exists(f'{Company.data_path}{self.sector_str}'):
-            mkdir(f'{Company.data_path}{self.sector_str}')
-        if not path.exists(f'{Company.data_path}{self.sector_str}/{self.industry_str}'):
-            mkdir(f'{Company.data_path}{self.sector_str}/{self.industry_str}')
-
-        self.sector_path = f'{Company.data_path}{self.sector_str}/_{self.sector_str}.json'
-        self.industry_path = f'{Company.data_path}{self.sector_str}/{self.industry_str}/_{self.industry_str}.json'
-        self.ticker_path = f'{Company.data_path}{self.sector_str}/{self.industry_str}/{self.ticker_str}.json'
-
-        if not self.is_new_ticker:
-            self.old_ticker = json.load(open(self.ticker_path, 'rt', encoding='utf-8'))
-        if path.exists(self.sector_path):
-            self.sector = json.load(open(self.sector_path, 'rt', encoding='utf-8'))
-        if path.exists(self.industry_path):
-            self.old_industry = json.load(open(self.industry_path, 'rt', encoding='utf-8'))
-
-    # Есть некоторая погрешность из-за none значений, потом поправлю путём пересчёта по тикерам
-    def upgrade_average_industry(self) -> None:
-        if self.old_industry:
+        # При оценке вызывается уже внутри транзакции хранилища: тикер, добавленный параллельно, считается старым
+        self.old_ticker = storage.store.load_ticker(self.sector_str, self.industry_str, self.ticker_str)
+        self.is_new_ticker = self.old_ticker is None
+        self.sector = storage.store.load_sector(self.sector_str) or dict()
+        self.old_industry = storage.store.load_industry(self.sector_str, self.industry_str) or dict()
+
+    def group_tickers(self, industry_str: Optional[str] = None) -> list[tuple[str, dict]]:
+        # Тикеры сектора (или индустрии) из хранилища, текущий - уже в новой версии
+        tickers = [(ticker_str, data) for ticker_str, data in storage.store.iter_group(self.sector_str, industry_str)
+                   if ticker_str != self.ticker_str]
+        return tickers + [(self.ticker_str, self.ticker)]
+
+    def upgrade_group(self, old_group: dict, industry_str: Optional[str] = None) -> dict:
+        if old_group and aggregate.is_exact(old_group):
+            group = copy.deepcopy(old_group)
             if self.is_new_ticker:
-                for iname in self.industry['indicators']:
-                    if self.ticker['indicators'][iname] is not None:
-                        self.industry['indicators'][iname] = {
-                            'avg': round(
-                                (self.industry['indicators'][iname]['avg'] + self.ticker['indicators'][iname]) / 2, 2),
-                            'acc': self.industry['indicators'][iname]['acc'] + self.ticker['indicators'][iname]
-                        }
+                aggregate.add_ticker(group, self.ticker)
             else:
-                for iname in self.industry["indicators"]:
-                    if self.ticker["indicators"][iname] is not None:
-                        dif: float = self.ticker["indicators"][iname] - self.old_ticker["indicators"][iname] \
-                            if self.old_ticker["indicators"][iname] is not None else self.ticker["indicators"][iname]
-                        self.industry["indicators"][iname]["acc"] = self.industry["indicators"][iname]["acc"] + dif
-                        self.industry["indicators"][iname]["avg"] = round(
-                            self.industry["indicators"][iname]["acc"] / self.industry["tickers"]["count"], 2)
+                aggregate.replace_ticker(group, self.old_ticker, self.ticker)
+            names = list(old_group['tickers']['data'])
         else:
-            for iname in self.ticker["indicators"]:
-                if self.ticker["indicators"][iname] is not None:
-                    self.industry["indicators"][iname] = {
-                        "avg": self.ticker["indicators"][iname],
-                        "acc": self.ticker["indicators"][iname]
-                    }
-                else:
-                    self.industry["indicators"][iname] = {'avg': 0.0, 'acc': 0.0}
-
-    # Есть некоторая погрешность из-за none значений, потом поправлю путём пересчёта по индустриям
-    def upgrade_average_sector(self, is_new_sector) -> None:
-        if not is_new_sector:
-            if self.old_industry:
-                for iname in self.sector["indicators"]:
-                    dif: float = self.industry["indicators"][iname]["acc"] - \
-                                 self.old_industry["indicators"][iname]["acc"] \
-                        if self.old_industry["indicators"][iname]["acc"] is not None \
-                        else self.industry["indicators"][iname]["acc"]
-                    self.sector["indicators"][iname]["acc"] = self.sector["indicators"][iname]["acc"] + dif
-                    self.sector["indicators"][iname]["avg"] = round(
-                        self.industry["indicators"][iname]["acc"] / self.sector["industries"]["count"], 2)
-            else:
-                for iname in self.sector["indicators"]:
-                    self.sector["indicators"][iname] = {
-                        "avg": (self.sector["indicators"][iname]["avg"] +
-                                round(self.industry["indicators"][iname]["acc"]) / 2, 2),
-                        "acc": self.sector["indicators"][iname]["acc"] + self.industry["indicators"][iname]["acc"]
-                    }
-        else:
-            for iname in self.industry["indicators"]:
-                self.sector["indicators"][iname] = {
-                    "avg": self.industry["indicators"][iname]["avg"],
-                    "acc": self.industry["indicators"][iname]["acc"]
-                }
-
-    def upgrade_sector_json(self, is_new_industry) -> None:
-        if self.sector:
-            is_new_sector = False
-            self.sector["lastUpdate"] = self.ticker["lastUpdate"]
-            if is_new_industry:
-                self.sector["base_rate"] = {
-                    "avg": round((self.sector["base_rate"]["avg"] + self.industry["base_rate"]["avg"]) / 2, 2),
-                    "acc": self.sector["base_rate"]["acc"] + self.industry["base_rate"]["avg"]
-                }
-                self.sector["industries"] = {
-                    "count": self.sector["industries"]["count"] + 1,
-                    "data": self.sector["industries"]["data"] + [self.industry_str]
-                }
-                self.sector["tickers"] = {
-                    "count": self.sector["tickers"]["count"] + 1,
-                    "data": self.sector["tickers"]["data"] + [self.ticker_str]
-                }
-            else:
-                self.sector["base_rate"]["acc"] = self.sector["base_rate"]["acc"] + \
-                                                  self.industry["base_rate"]["avg"] - \
-                                                  self.old_industry["base_rate"]["avg"]
-                self.sector["base_rate"]["avg"] = round(self.sector["base_rate"]["acc"]
-                                                        / self.sector["industries"]["count"], 2)
-                if self.is_new_ticker:
-                    self.sector["tickers"].update({
-                        "count": self.sector["tickers"]["count"] + 1,
-                        "data": self.sector["tickers"]["data"] + [self.ticker_str]
-                    })
-        else:
-            is_new_sector = True
-            self.sector = {
-                'industries': {
-                    "count": 1,
-                    "data": [self.industry_str]
-                },
-                'tickers': {
-                    "count": 1,
-                    "data": [self.ticker_str]
-                },
-                'lastUpdate': self.ticker["lastUpdate"],
-                'base_rate': {
-                    "avg": self.industry["base_rate"]["avg"],
-                    "acc": self.industry["base_rate"]["acc"]
-                },
-                'indicators': {}
-            }
-        self.upgrade_average_sector(is_new_sector)
+            # Новая группа или файл старого формата acc/avg: собираем агрегат по тикерам заново
+            tickers = self.group_tickers(industry_str)
+            group = dict(old_group)
+            group.update(aggregate.rebuild(data for _, data in tickers))
+            names = [ticker_str for ticker_str, _ in tickers]
+        if self.ticker_str not in names:
+            names.append(self.ticker_str)
+        group['tickers'] = {'count': len(names), 'data': names}
+        group['lastUpdate'] = self.ticker['lastUpdate']
+        return group
+
+    def upgrade_sector_json(self) -> None:
+        old_sector = self.sector
+        self.sector = self.upgrade_group(old_sector)
+        industries = list(old_sector['industries']['data']) if old_sector else []
+        if self.industry_str not in industries:
+            industries.append(self.industry_str)
+        self.sector['industries'] = {'count': len(industries), 'data': industries}
 
     def upgrade_industry_json(self) -> None:
-        if self.old_industry:
-            is_new_industry = False
-            self.industry = dict(self.old_industry)
-            self.industry["lastUpdate"] = self.ticker["lastUpdate"]
-            if self.is_new_ticker:
-                self.industry["base_rate"] = {
-                    "avg": round((self.industry["base_rate"]["avg"] + self.ticker["base_rate"]) / 2.0, 2),
-                    "acc": self.industry["base_rate"]["acc"] + self.ticker["base_rate"]
-                }
-                self.industry["tickers"] = {
-                    "count": self.industry["tickers"]["count"] + 1,
-                    "data": self.industry["tickers"]["data"] + [self.ticker_str]
-                }
-            else:
-                self.industry["base_rate"]["acc"] = self.industry["base_rate"]["acc"] + \
-                                                    self.ticker["base_rate"] - self.old_ticker["base_rate"]
-                self.industry["base_rate"]["avg"] = round(
-                    self.industry["base_rate"]["acc"] / self.industry["tickers"]["count"], 2)
-        else:
-            is_new_industry = True
-            self.industry = {
-                'tickers': {
-                    'count': 1,
-                    'data': [self.ticker_str]
-                },
-                'lastUpdate': self.ticker["lastUpdate"],
-                'base_rate': {
-                    'avg': self.ticker["base_rate"],
-                    'acc': self.ticker["base_rate"]
-                },
-                'indicators': {}
-            }
-        self.upgrade_average_industry()
-        self.upgrade_sector_json(is_new_industry)
+        self.industry = self.upgrade_group(self.old_industry, self.industry_str)
+        self.upgrade_sector_json()
 
     def upgrade_ticker_json(self) -> None:
         self.ticker = {
@@ -423,198 +369,54 @@ class Company:
             'base_rate': round(self.get_base_rate, 2),
             'relative_rate': {},
             'dcf': self.compute_dcf,
+            # Входы DCF для сетки чувствительности и Монте-Карло, их считает отчёт, если они в нём включены
+            'dcf_inputs': self.dcf_inputs,
             'lastUpdate': round(time.time()),
             'key_statements': self.get_key_statements,
             'indicators': self.get_indicators
         }
+
+    def estimate_groups(self) -> tuple[dict, dict, dict]:
+        # Вызывается из storage.store.commit_estimate: группы перечитываются и обновляются там же, где пишутся
+        self.prepare_data()
         self.upgrade_industry_json()
         self.ticker['relative_rate'] = self.get_relative_rate(self.ticker['base_rate'], self.ticker['indicators'])
+        return self.ticker, self.industry, self.sector
 
     def remove_ticker(self):
-        sector_str = self.all_tickers[self.ticker_str]['sector']
-        industry_str = self.all_tickers[self.ticker_str]['industry']
-        sector_path = f'{Company.data_path}{sector_str}/_{sector_str}.json'
-        industry_path = f'{Company.data_path}{sector_str}/{industry_str}/_{industry_str}.json'
-        ticker_path = f'{Company.data_path}{sector_str}/{industry_str}/{self.ticker_str}.json'
-
-        ticker = json.load(open(ticker_path, 'rt', encoding='utf-8'))
-        sector = json.load(open(sector_path, 'rt', encoding='utf-8'))
-        industry = json.load(open(industry_path, 'rt', encoding='utf-8'))
-        industry['tickers']['count'] -= 1
-        industry['tickers']['data'].remove(self.ticker_str)
-        industry['base_rate']['acc'] -= ticker['base_rate']
-        industry['base_rate']['avg'] = round(industry['base_rate']['acc'] / industry['tickers']['count'], 2)
-        for element in industry['indicators']:
-            industry['indicators'][element]['acc'] -= ticker['indicators'][element]
-            industry['indicators'][element]['avg'] = round(industry['indicators'][element]['acc'] /
-                                                           industry['tickers']['count'], 4)
-
-        sector['tickers']['count'] -= 1
-        sector['tickers']['data'].remove(self.ticker_str)
-        sector['base_rate']['acc'] -= industry['base_rate']['avg']
-        sector['base_rate']['avg'] = round(sector['base_rate']['acc'] / sector['tickers']['count'], 2)
-        for element in industry['indicators']:
-            sector['indicators'][element]['acc'] -= industry['indicators'][element]['avg']
-            sector['indicators'][element]['avg'] = round(sector['indicators'][element]['acc'] /
-                                                         sector['tickers']['count'], 4)
-        os.remove(ticker_path)
+        sector_str = self.meta['sector']
+        industry_str = self.meta['industry']
+
+        def remove() -> tuple[dict, dict]:
+            # Вызывается из storage.store.commit_removal, как estimate_groups из commit_estimate
+            ticker = storage.store.load_ticker(sector_str, industry_str, self.ticker_str)
+            sector = storage.store.load_sector(sector_str)
+            industry = storage.store.load_industry(sector_str, industry_str)
+            for group, group_industry in ((industry, industry_str), (sector, None)):
+                if aggregate.is_exact(group):
+                    aggregate.remove_ticker(group, ticker)
+                else:
+                    group.update(aggregate.rebuild(
+                        data for ticker_str, data in storage.store.iter_group(sector_str, group_industry)
+                        if ticker_str != self.ticker_str))
+                group['tickers']['data'].remove(self.ticker_str)
+                group['tickers']['count'] = len(group['tickers']['data'])
+            if industry['tickers']['count'] == 0 and industry_str in sector['industries']['data']:
+                sector['industries']['data'].remove(industry_str)
+                sector['industries']['count'] = len(sector['industries']['data'])
+            return industry, sector
+
+        storage.store.commit_removal(sector_str, industry_str, self.ticker_str, remove)
+        reports.cache.touch(self.ticker_str, sector_str, industry_str)
         self.is_new_ticker = True
-        json.dump(sector, open(sector_path, 'wt', encoding='utf-8'))
-        json.dump(industry, open(industry_path, 'wt', encoding='utf-8'))
 
     @property
     def compute_dcf(self) -> Optional[float]:
-        import numpy as np
         risk_free, market_rate_all, estimates, income, cashflow, balance, ev = network.get_dcf_data(self.ticker_str)
-        if ev:
-            ev = ev[0]
-        else:
-            return None
         profile = network.get_profile(self.ticker_str)
-        if len(income) < 5:
-            return None
-
-        income.reverse()
-        cashflow.reverse()
-        balance.reverse()
-        estimates.reverse()
-
-        # Base
-        ebit: list = [data["operatingIncome"] for data in income]
-        tax_rate = abs(income[-1]["incomeTaxExpense"]) / ebit[-1] if ebit[-1] > 0.0 else 0.0
-        rev: list = [data["revenue"] for data in income]
-        d_a: list = [data["depreciationAndAmortization"] for data in income]
-        cap_ex: list = [abs(data["capitalExpenditure"]) for data in cashflow]
-        nwc: list = [data["netReceivables"] + data["inventory"] -
-                     data["accountPayables"] - data['deferredRevenue'] for data in balance]
-        for i in (rev, cap_ex):
-            if 0.0 in i:
-                return None
-
-        last_rep_year = time.strptime(income[-1]["date"], '%Y-%m-%d').tm_year
-        est_year = time.strptime(estimates[0]["date"], '%Y-%m-%d').tm_year if estimates else last_rep_year + 1
-        while last_rep_year >= est_year:
-            estimates = estimates[1:]
-            est_year = time.strptime(estimates[0]["date"], '%Y-%m-%d').tm_year
-
-        # Revenue
-        rev_g = [get_growth(rev[i], item) for i, item in enumerate(rev[1:])]
-        rev_est = []
-        rev_est_g = []
-        if estimates:
-            rev_est = [(est["estimatedRevenueLow"] + est["estimatedRevenueHigh"]) / 2 for est in estimates]
-            rev_est_g = [get_growth(rev[-1], rev_est[0])] + \
-                        [get_growth(rev_est[i - 1], rev_est[i]) for i in range(1, len(rev_est))]
-
-        rev_g_ma = 0.0
-        rev_all_g = rev_g + rev_est_g
-        years = len(rev_all_g) + 1
-        for i, value in enumerate(rev_all_g):
-            rev_g_ma = rev_g_ma * (1 - ((1 + i) / years)) + value * ((1 + i) / years)
-
-        # EBIT
-        ebit_prc = [_ebit / _rev for _ebit, _rev in zip(ebit, rev)]
-        ebit_prc_g = [get_growth(ebit_prc[i], item) for i, item in enumerate(ebit_prc[1:])]
-        ebit_est_prc = []
-        ebit_est_prc_g = []
-        if estimates:
-            ebit_est = [(est["estimatedEbitLow"] + est["estimatedEbitHigh"]) / 2 for est in estimates]
-            ebit_est_prc = [_ebit_est / _rev_est for _ebit_est, _rev_est in zip(ebit_est, rev_est)]
-            ebit_est_prc_g = [get_growth(ebit_prc[-1], ebit_est_prc[0])] + \
-                             [get_growth(ebit_est_prc[i], item) for i, item in enumerate(ebit_est_prc[1:])]
-
-        ebit_prc_ma = 0.0
-        ebit_prc_all = ebit_prc + ebit_est_prc
-        years = len(ebit_prc_all) + 1
-        for i, value in enumerate(ebit_prc_all):
-            ebit_prc_ma = ebit_prc_ma * (1 - ((1 + i) / years)) + value * ((1 + i) / years)
-
-        ebit_prc_g_ma = 0.0
-        ebit_prc_all_g = ebit_prc_g + ebit_est_prc_g
-        years = len(ebit_prc_all_g) + 1
-        for i, value in enumerate(ebit_prc_all_g):
-            ebit_prc_g_ma = ebit_prc_g_ma * (1 - ((1 + i) / years)) + value * ((1 + i) / years)
-
-        last_ebit_prc = ebit_prc_ma + (abs(ebit_prc_ma) * ebit_prc_g_ma)
-
-        # CapEx
-        cap_ex_prc = [_cap_ex / _rev for _cap_ex, _rev in zip(cap_ex, rev)]
-
-        years = len(cap_ex_prc) + 1
-        cap_ex_prc_ma = 0.0
-        for i, value in enumerate(cap_ex_prc):
-            cap_ex_prc_ma = cap_ex_prc_ma * (1 - (2 / years)) + value * (2 / years)
-
-        # D&A
-        d_a_prc = [_d_a / _cap_ex for _d_a, _cap_ex in zip(d_a, cap_ex)]
-
-        years = len(d_a_prc) + 1
-        d_a_prc_ma = 0.0
-        for i, value in enumerate(d_a_prc):
-            d_a_prc_ma = d_a_prc_ma * (1 - (2 / years)) + value * (2 / years)
-
-        # NWC
-        nwc_prc = [item / rev[i] for i, item in enumerate(nwc)]
-        nwc_prc_g = [get_growth(nwc_prc[i], item) for i, item in enumerate(nwc_prc[1:])]
-
-        years = len(nwc_prc) + 1
-        nwc_prc_ma = 0.0
-        for i, value in enumerate(nwc_prc):
-            nwc_prc_ma = nwc_prc_ma * (1 - ((1 + i) / years)) + value * ((1 + i) / years)
-
-        years = len(nwc_prc_g) + 1
-        nwc_prc_g_ma = 0.0
-        for i, value in enumerate(nwc_prc_g):
-            nwc_prc_g_ma = nwc_prc_g_ma * (1 - ((1 + i) / years)) + value * ((1 + i) / years)
-
-        last_nwc_prc = nwc_prc_ma + (abs(nwc_prc_ma) * nwc_prc_g_ma)
-
-        # Calculate full data
-        rev = [rev[-1]]
-        for i in range(10):
-            rev.append(round(rev[i] * (1 + rev_g_ma)))
-        ebit.clear()
-        for i, _ebit_prc in enumerate((np.linspace(ebit_prc[-1], last_ebit_prc, 11)).real):
-            ebit.append(round(rev[i] * _ebit_prc))
-        cap_ex = [round(cap_ex_prc_ma * item) for item in rev[1:]]
-        d_a = [round(d_a_prc_ma * item) for item in cap_ex]
-        nwc.clear()
-        for i, _c_nwc_prc in enumerate((np.linspace(nwc_prc[-1], last_nwc_prc, 11)).real):
-            nwc.append(round(rev[i] * _c_nwc_prc))
-        c_nwc = [item - nwc[i] for i, item in enumerate(nwc[1:])]
-
-        rev = rev[1:]
-        ebit = ebit[1:]
-        # WACC
-        market_rate = 0.08
-        for country in market_rate_all:
-            if country['country'] == Company.countries[profile['country']]:
-                market_rate = country['totalEquityRiskPremium'] / 100
-                break
-        beta = profile["beta"]
-        equity = balance[-1]["totalEquity"]
-        cost_of_equity = risk_free + beta * market_rate
-        debt = balance[-1]["totalDebt"]
-        cost_of_debt = abs(income[-1]["interestExpense"]) / balance[-1]["totalDebt"] \
-            if balance[-1]["totalDebt"] != 0.0 else 0.0
-
-        wacc = (equity / (equity + debt)) * cost_of_equity + (debt / (equity + debt)) * cost_of_debt * (1 - tax_rate)
-
-        # Terminal values and UFCF
-        terminal_growth_rate = 0.025
-
-        u_fcf = [round(ebit[i] * (1 - tax_rate) + d_a[i] - cap_ex[i] - c_nwc[i]) for i in range(len(rev))]
-
-        terminl_value = round((u_fcf[-1] * (1 + terminal_growth_rate)) / (wacc - terminal_growth_rate))
-        present_value_fcf = [round(item / ((1 + wacc) ** (i + 1))) for i, item in enumerate(u_fcf)]
-        present_value_tv = round(terminl_value / ((1 + wacc) ** 10))
-        pv_ev = sum(present_value_fcf) + present_value_tv
-        cash = ev["minusCashAndCashEquivalents"]
-        shares = ev["numberOfShares"]
-        if shares == 0:
-            return None
-        price = (pv_ev + cash - debt) / shares
-        return round(price, 2)
+        self.dcf_inputs = dcf.prepare(risk_free, market_rate_all, estimates, income, cashflow, balance, ev,
+                                      profile, Company.countries)
+        return dcf.value_many([self.dcf_inputs])[0]
 
     @property
     def get_base_rate(self) -> float:
@@ -892,45 +694,78 @@ class Company:
 
         self.sector_str = self.data[DataType.PROFILE.value]['sector']
         self.industry_str = self.data[DataType.PROFILE.value]['industry']
-        if (self.sector_str != self.all_tickers[self.ticker_str]['sector'] or
-            self.industry_str != self.all_tickers[self.ticker_str]['industry']) and not self.is_new_ticker:
+        if not self.is_new_ticker and (self.sector_str != self.meta['sector'] or
+                                       self.industry_str != self.meta['industry']):
             self.remove_ticker()
 
-        self.prepare_data()
         self.upgrade_ticker_json()
 
-        json.dump(self.ticker, open(self.ticker_path, 'wt', encoding='utf-8'))
-        json.dump(self.industry, open(self.industry_path, 'wt', encoding='utf-8'))
-        json.dump(self.sector, open(self.sector_path, 'wt', encoding='utf-8'))
-
-        self.all_tickers[self.ticker_str] = {
+        self.meta = {
             'version': self.version,
             'sector': self.sector_str,
             'industry': self.industry_str,
             'lastUpdate': self.ticker['lastUpdate']
         }
-        if self.is_new_ticker:
-            self.all_tickers['count'] = self.all_tickers['count'] + 1
-        json.dump(self.all_tickers, open(f'{Company.data_path}all_tickers.json', 'wt', encoding='utf-8'))
+        # Тикер, индустрия, сектор и индекс тикеров пересчитываются от свежих групп и записываются одной транзакцией
+        storage.store.commit_estimate(self.sector_str, self.industry_str, self.ticker_str, self.meta,
+                                      self.estimate_groups)
+        peers.matrix.upsert(self.ticker_str, self.sector_str, self.industry_str, self.ticker)
+        self.report_version = reports.cache.touch(self.ticker_str, self.sector_str, self.industry_str,
+                                                  self.meta['lastUpdate'])
 
     def upload_data(self) -> None:
-        self.sector_str = self.all_tickers[self.ticker_str]['sector']
-        self.industry_str = self.all_tickers[self.ticker_str]['industry']
+        self.sector_str = self.meta['sector']
+        self.industry_str = self.meta['industry']
+        # Версия снимается до чтения: если группу переоценят параллельно, запись в reports.cache сразу устареет
+        self.report_version = reports.cache.version(self.meta)
         self.prepare_data()
         self.ticker = self.old_ticker
         self.industry = self.old_industry
         if (None in self.ticker['relative_rate']['base']) | (None in self.ticker['relative_rate']['wide']):
             self.ticker['relative_rate'] = self.get_relative_rate(self.ticker["base_rate"], self.ticker["indicators"])
-            json.dump(self.ticker, open(self.ticker_path, 'wt', encoding='utf-8'))
+            storage.store.save_ticker(self.sector_str, self.industry_str, self.ticker_str, self.ticker)
+            reports.cache.invalidate(self.ticker_str)
 
     def is_time_to_update(self, sec_time: float) -> bool:
         last_update = time.gmtime(sec_time)
-        last_report = time.strptime(network.get_last_report_data(self.ticker_str), '%Y-%m-%d')
-        return True if last_report > last_update else False
+        # Дата из календаря отчётов, в API - только если календарь о тикере давно ничего не знает
+        last_report = time.strptime(filings.calendar.report_date(self.ticker_str), '%Y-%m-%d')
+        if last_report > last_update:
+            # Вышел новый отчёт, закэшированная отчётность устарела
+            network.cache.invalidate(self.ticker_str)
+            return True
+        return False
 
     def get_company_data(self) -> (bool, bool):
-        self.all_tickers = json.load(open(f'{Company.data_path}all_tickers.json', 'rt', encoding='utf-8'))
-        if self.ticker_str in self.all_tickers:
-            return False, self.is_time_to_update(self.all_tickers[self.ticker_str]['lastUpdate'])
+        self.meta = storage.store.get_meta(self.ticker_str)
+        if self.meta is not None:
+            return False, self.is_time_to_update(self.meta['lastUpdate'])
         else:
             return True, True
+
+
+class CompanyView:
+    # Отчёт и график по уже посчитанному тикеру только на чтение: без download_data, проверок отчётности
+    # и записи в хранилище. Данные читаются по первому обращению, агрегаты индустрии или сектора - только
+    # если их просит блок оценки в настройках отчёта
+    def __init__(self, _ticker: str, meta: dict):
+        self.ticker_str = _ticker
+        self.meta = meta
+        self.sector_str = meta['sector']
+        self.industry_str = meta['industry']
+        self.report_version = reports.cache.version(meta)
+
+    @cached_property
+    def ticker(self) -> dict:
+        return storage.store.load_ticker(self.sector_str, self.industry_str, self.ticker_str)
+
+    @cached_property
+    def industry(self) -> dict:
+        return storage.store.load_industry(self.sector_str, self.industry_str) or dict()
+
+    @cached_property
+    def sector(self) -> dict:
+        return storage.store.load_sector(self.sector_str) or dict()
+
+    generate_report = Company.generate_report
+    generate_chart = Company.generate_chart
@@ -0,0 +1,266 @@
+import gc
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from matplotlib import dates, ticker as tckr
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from typing import Optional
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Графики рисуются в отдельных процессах через Agg без pyplot: у каждого воркера одна заранее
+# оформленная фигура, на рендер меняются только данные линий и подписи
+chart_workers: int = 2
+render_timeout: float = 30.0
+figsize: tuple[float, float] = (10, 6)
+dpi: int = 100
+# Подсчёт фигур обходит весь gc (~10 мс), поэтому не на каждом рендере
+leak_check_every: int = 50
+plots_path: str = '\\FinancialData/Plots/'
+max_cache_bytes: int = 200 * 1024 * 1024
+# Закрытие торгов NYSE в UTC (16:00 ET, без учёта перехода на летнее время)
+market_close_hour: int = 21
+
+
+class ChartTemplate:
+    def __init__(self):
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(self.figure)
+        self.ax = ax = self.figure.add_subplot()
+        self.title = ax.set_title('', loc='left', y=0.9, x=0.01, fontsize=20, backgroundcolor='white')
+        # X-axis
+        ax.xaxis.set_major_formatter(dates.DateFormatter("%b '%y"))
+        ax.xaxis.set_major_locator(dates.MonthLocator())
+        ax.tick_params(axis='x', labelrotation=45)
+        # Y-axis
+        ax.spines["top"].set_visible(False)
+        ax.spines["left"].set_visible(False)
+        ax.yaxis.tick_right()
+
+        self.line, = ax.plot([], [])
+        self.last_line = ax.axhline(0, color='gray', linestyle='--', linewidth=0.6)
+        self.last_text = ax.text(0, 0, '', size=10, ha="center", va="center",
+                                 bbox=dict(boxstyle="round", facecolor='white'))
+
+    def render(self, plot_path: str, title: str, date_list: np.ndarray, data_list: np.ndarray) -> None:
+        ax = self.ax
+        self.title.set_text(title)
+        order = (str(round(max(data_list))).__len__() - 2)
+        if order == 0:
+            order = 1
+        ax.yaxis.set_major_locator(tckr.MultipleLocator(10 ** order))
+        ax.yaxis.set_minor_locator(tckr.MultipleLocator((10 ** order) / 2))
+
+        self.line.set_data(date_list, data_list)
+        self.last_line.set_ydata([data_list[-1], data_list[-1]])
+        self.last_text.set_position((date_list[-1] + 30, data_list[-1]))
+        self.last_text.set_text(str(data_list[-1]))
+        ax.relim()
+        ax.autoscale_view()
+
+        self.figure.savefig(plot_path, bbox_inches='tight')
+
+
+# Шаблон живёт в процессе воркера
+template: Optional[ChartTemplate] = None
+worker_renders: int = 0
+
+
+def init_worker() -> None:
+    global template
+    template = ChartTemplate()
+
+
+def count_figures() -> int:
+    # Больше одной фигуры в воркере - утечка
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, Figure))
+
+
+def render_in_worker(plot_path: str, title: str, days: np.ndarray, closes: np.ndarray) -> dict:
+    global worker_renders
+    start = time.perf_counter()
+    template.render(plot_path, title, dates.date2num(days.astype('datetime64[D]')), closes)
+    worker_renders += 1
+    return {
+        'pid': os.getpid(),
+        'seconds': time.perf_counter() - start,
+        # ru_maxrss в Linux - в килобайтах
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        'figures': count_figures() if worker_renders % leak_check_every == 1 else None
+    }
+
+
+class ChartRenderer:
+    def __init__(self, workers: int = chart_workers):
+        self.workers = workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.lock = threading.Lock()
+        self.stats = {'renders': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'workers': {}}
+
+    def pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                # spawn, а не fork: к этому моменту в боте уже работают потоки updater и job queue,
+                # и форк мог бы унести в воркер чужую захваченную блокировку
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def start(self) -> None:
+        # Поднимаем воркеры при старте бота, чтобы первый график не ждал импорта matplotlib
+        futures = [self.pool().submit(os.getpid) for _ in range(self.workers)]
+        for future in futures:
+            future.result(timeout=render_timeout)
+
+    def render(self, plot_path: str, title: str, days: np.ndarray, closes: np.ndarray) -> str:
+        # days (от 1970-01-01) и closes - от старых к новым, как в prices.store
+        try:
+            result = self.pool().submit(render_in_worker, plot_path, title, days, closes) \
+                .result(timeout=render_timeout)
+        except BrokenProcessPool:
+            # Воркер упал: следующий рендер поднимет пул заново
+            with self.lock:
+                self.executor = None
+                self.stats['errors'] += 1
+            raise
+        except Exception:
+            with self.lock:
+                self.stats['errors'] += 1
+            raise
+        with self.lock:
+            self.stats['renders'] += 1
+            self.stats['seconds'] += result['seconds']
+            self.stats['max_seconds'] = max(self.stats['max_seconds'], result['seconds'])
+            worker = self.stats['workers'].setdefault(result['pid'], {'renders': 0})
+            worker['renders'] += 1
+            worker['max_rss_kb'] = result['max_rss_kb']
+            if result['figures'] is not None:
+                worker['figures'] = result['figures']
+        return plot_path
+
+    def shutdown(self) -> None:
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+
+def last_trading_date(now: Optional[float] = None) -> str:
+    # Последний день с закрытой торговой сессией: до закрытия - предыдущий, выходные пропускаются.
+    # Праздники не учитываются: в праздник график просто перерисуется один лишний раз
+    seconds = time.time() if now is None else now
+    day = time.gmtime(seconds)
+    if day.tm_hour < market_close_hour:
+        seconds -= 86400
+    day = time.gmtime(seconds)
+    while day.tm_wday >= 5:
+        seconds -= 86400
+        day = time.gmtime(seconds)
+    return time.strftime('%Y-%m-%d', day)
+
+
+def chart_key(ticker: str, days: int, trading_date: str) -> str:
+    return f'{ticker}_{days}_{trading_date}'
+
+
+class ChartCache:
+    # PNG графиков по ключу (тикер, диапазон, последний торговый день): новая сессия - новый ключ,
+    # так что устаревший график никогда не отдаётся. Индекс хранит размер файлов для LRU-вытеснения
+    # по суммарному объёму и file_id Telegram после первой отправки
+    def __init__(self, _plots_path: str = plots_path, max_bytes: int = max_cache_bytes):
+        self.plots_path = _plots_path
+        self.max_bytes = max_bytes
+        self.index_path = f'{_plots_path}index.json'
+        # key -> {'ticker', 'days', 'size', 'file_id'}, порядок - от давно использованных к недавним
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.total_bytes = 0
+        self.is_loaded = False
+        self.lock = threading.RLock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'file_id_hits': 0}
+
+    def path(self, key: str) -> str:
+        return f'{self.plots_path}{key}.png'
+
+    def load(self) -> None:
+        with self.lock:
+            if self.is_loaded:
+                return
+            if os.path.exists(self.index_path):
+                for key, entry in json.load(open(self.index_path, 'rt')).items():
+                    # Файл могли удалить руками
+                    if os.path.exists(self.path(key)):
+                        self.entries[key] = entry
+                        self.total_bytes += entry['size']
+            self.is_loaded = True
+
+    def save(self) -> None:
+        with open(f'{self.index_path}.tmp', 'wt') as file:
+            json.dump(self.entries, file)
+        os.replace(f'{self.index_path}.tmp', self.index_path)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+
+    def put(self, key: str, ticker: str, days: int) -> None:
+        # Вызывается после того, как PNG записан по path(key)
+        with self.lock:
+            self.load()
+            for old_key in [old_key for old_key, entry in self.entries.items()
+                            if entry['ticker'] == ticker and entry['days'] == days and old_key != key]:
+                # График прошлой сессии больше не понадобится
+                self.drop(old_key)
+            if key in self.entries:
+                self.total_bytes -= self.entries[key]['size']
+            size = os.path.getsize(self.path(key))
+            self.entries[key] = {'ticker': ticker, 'days': days, 'size': size, 'file_id': None}
+            self.entries.move_to_end(key)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                self.drop(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+            self.save()
+
+    def drop(self, key: str) -> None:
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry['size']
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def file_id(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['file_id'] is None:
+                return None
+            self.stats['file_id_hits'] += 1
+            return entry['file_id']
+
+    def set_file_id(self, key: str, file_id: str) -> None:
+        with self.lock:
+            if key in self.entries:
+                self.entries[key]['file_id'] = file_id
+                self.save()
+
+
+renderer = ChartRenderer()
+cache = ChartCache()
@@ -0,0 +1,290 @@
+import hashlib
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+
+projection_years: int = 10
+terminal_growth_rate: float = 0.025
+default_market_rate: float = 0.08
+
+
+def get_growth(_from: float, _to: float) -> float:
+    if (_from != 0.0) & (None not in [_from, _to]):
+        return (_to - _from) / abs(_from)
+    else:
+        return 0.0
+
+
+def growths(values: list) -> list:
+    return [get_growth(values[i], item) for i, item in enumerate(values[1:])]
+
+
+def prepare(risk_free: float, market_rate_all: list, estimates: list, income: list, cashflow: list,
+            balance: list, ev: list, profile: dict, countries: dict) -> Optional[dict]:
+    # Разбор ответов API одного тикера в ряды и скаляры для пакетного расчёта.
+    # None - там же, где его возвращал старый compute_dcf
+    if not ev:
+        return None
+    ev = ev[0]
+    if len(income) < 5:
+        return None
+
+    income = list(reversed(income))
+    cashflow = list(reversed(cashflow))
+    balance = list(reversed(balance))
+    estimates = list(reversed(estimates))
+
+    ebit: list = [data["operatingIncome"] for data in income]
+    tax_rate = abs(income[-1]["incomeTaxExpense"]) / ebit[-1] if ebit[-1] > 0.0 else 0.0
+    rev: list = [data["revenue"] for data in income]
+    d_a: list = [data["depreciationAndAmortization"] for data in income]
+    cap_ex: list = [abs(data["capitalExpenditure"]) for data in cashflow]
+    nwc: list = [data["netReceivables"] + data["inventory"] -
+                 data["accountPayables"] - data['deferredRevenue'] for data in balance]
+    for i in (rev, cap_ex):
+        if 0.0 in i:
+            return None
+    if ev["numberOfShares"] == 0:
+        return None
+
+    # Оценки аналитиков только на годы после последнего отчёта
+    last_rep_year = time.strptime(income[-1]["date"], '%Y-%m-%d').tm_year
+    while estimates and time.strptime(estimates[0]["date"], '%Y-%m-%d').tm_year <= last_rep_year:
+        estimates = estimates[1:]
+
+    rev_est = [(est["estimatedRevenueLow"] + est["estimatedRevenueHigh"]) / 2 for est in estimates]
+    ebit_est = [(est["estimatedEbitLow"] + est["estimatedEbitHigh"]) / 2 for est in estimates]
+    ebit_prc = [_ebit / _rev for _ebit, _rev in zip(ebit, rev)]
+    ebit_est_prc = [_ebit_est / _rev_est for _ebit_est, _rev_est in zip(ebit_est, rev_est)]
+    nwc_prc = [item / rev[i] for i, item in enumerate(nwc)]
+
+    market_rate = default_market_rate
+    for country in market_rate_all:
+        if country['country'] == countries[profile['country']]:
+            market_rate = country['totalEquityRiskPremium'] / 100
+            break
+    debt = balance[-1]["totalDebt"]
+
+    return {
+        'date': income[-1]["date"],
+        'series': {
+            'rev_g': growths(rev) + growths([rev[-1]] + rev_est),
+            'ebit_prc': ebit_prc + ebit_est_prc,
+            'ebit_prc_g': growths(ebit_prc) + growths([ebit_prc[-1]] + ebit_est_prc),
+            'cap_ex_prc': [_cap_ex / _rev for _cap_ex, _rev in zip(cap_ex, rev)],
+            'd_a_prc': [_d_a / _cap_ex for _d_a, _cap_ex in zip(d_a, cap_ex)],
+            'nwc_prc': nwc_prc,
+            'nwc_prc_g': growths(nwc_prc)
+        },
+        'rev': rev[-1],
+        'ebit_prc': ebit_prc[-1],
+        'nwc_prc': nwc_prc[-1],
+        'tax_rate': tax_rate,
+        'risk_free': risk_free,
+        'market_rate': market_rate,
+        'beta': profile["beta"],
+        'equity': balance[-1]["totalEquity"],
+        'debt': debt,
+        'cost_of_debt': abs(income[-1]["interestExpense"]) / debt if debt != 0.0 else 0.0,
+        'cash': ev["minusCashAndCashEquivalents"],
+        'shares': ev["numberOfShares"]
+    }
+
+
+def pad(rows: list[list]) -> tuple[np.ndarray, np.ndarray]:
+    # Ряды разной длины -> матрица с нулями справа и вектор длин
+    lengths = np.array([len(row) for row in rows])
+    values = np.zeros((len(rows), max(lengths.max(initial=0), 1)))
+    for i, row in enumerate(rows):
+        values[i, :len(row)] = row
+    return values, lengths
+
+
+def linear_alphas(lengths: np.ndarray, width: int) -> np.ndarray:
+    # Веса (i + 1) / (n + 1): чем свежее значение, тем больше его вес
+    i = np.arange(width)
+    alphas = (i + 1) / (lengths[:, None] + 1.0)
+    return np.where(i < lengths[:, None], alphas, 0.0)
+
+
+def ema_alphas(lengths: np.ndarray, width: int) -> np.ndarray:
+    # Экспоненциальное сглаживание с постоянным весом 2 / (n + 1)
+    i = np.arange(width)
+    alphas = np.broadcast_to(2.0 / (lengths[:, None] + 1.0), (len(lengths), width))
+    return np.where(i < lengths[:, None], alphas, 0.0)
+
+
+def weighted_ma(values: np.ndarray, alphas: np.ndarray) -> np.ndarray:
+    # Свёртка рекурсии ma = ma * (1 - a_i) + v_i * a_i (ma_0 = 0) по последней оси:
+    # ma = sum_i v_i * a_i * prod_{j > i} (1 - a_j). Нулевой вес на хвосте паддинга ничего не меняет
+    keep = np.cumprod((1.0 - alphas)[..., ::-1], axis=-1)[..., ::-1]
+    after = np.concatenate([keep[..., 1:], np.ones(keep.shape[:-1] + (1,))], axis=-1)
+    return np.sum(values * alphas * after, axis=-1)
+
+
+def moving_average(rows: list[list], kind: str = 'linear') -> np.ndarray:
+    values, lengths = pad(rows)
+    alphas = linear_alphas(lengths, values.shape[1]) if kind == 'linear' else ema_alphas(lengths, values.shape[1])
+    return weighted_ma(values, alphas)
+
+
+def estimate_params(inputs: list[dict]) -> dict[str, np.ndarray]:
+    # Точечные оценки драйверов модели для пачки тикеров, каждая - вектор длины len(inputs)
+    series = {name: [item['series'][name] for item in inputs] for name in inputs[0]['series']}
+    params = {name: np.array([item[name] for item in inputs], dtype=float)
+              for name in ('rev', 'ebit_prc', 'nwc_prc', 'tax_rate', 'risk_free', 'market_rate', 'beta',
+                           'equity', 'debt', 'cost_of_debt', 'cash', 'shares')}
+
+    ebit_prc_ma = moving_average(series['ebit_prc'])
+    nwc_prc_ma = moving_average(series['nwc_prc'])
+    params.update({
+        'rev_g': moving_average(series['rev_g']),
+        'last_ebit_prc': ebit_prc_ma + np.abs(ebit_prc_ma) * moving_average(series['ebit_prc_g']),
+        'cap_ex_prc': moving_average(series['cap_ex_prc'], 'ema'),
+        'd_a_prc': moving_average(series['d_a_prc'], 'ema'),
+        'last_nwc_prc': nwc_prc_ma + np.abs(nwc_prc_ma) * moving_average(series['nwc_prc_g']),
+        'terminal_growth': np.full(len(inputs), terminal_growth_rate)
+    })
+    return params
+
+
+def project(params: dict[str, np.ndarray]) -> np.ndarray:
+    # Прогноз UFCF на projection_years лет, форма (..., projection_years).
+    # Параметры могут быть любой согласованной формы: пачка тикеров или выборка Монте-Карло
+    years = np.arange(projection_years + 1)
+    step = years / projection_years
+
+    def col(name: str) -> np.ndarray:
+        return np.asarray(params[name])[..., None]
+
+    rev = col('rev') * (1.0 + col('rev_g')) ** years
+    ebit = rev * (col('ebit_prc') + (col('last_ebit_prc') - col('ebit_prc')) * step)
+    cap_ex = col('cap_ex_prc') * rev[..., 1:]
+    d_a = col('d_a_prc') * cap_ex
+    nwc = rev * (col('nwc_prc') + (col('last_nwc_prc') - col('nwc_prc')) * step)
+    c_nwc = np.diff(nwc, axis=-1)
+    return ebit[..., 1:] * (1.0 - col('tax_rate')) + d_a - cap_ex - c_nwc
+
+
+def get_wacc(params: dict[str, np.ndarray]) -> np.ndarray:
+    equity, debt = np.asarray(params['equity']), np.asarray(params['debt'])
+    cost_of_equity = params['risk_free'] + params['beta'] * params['market_rate']
+    return (equity / (equity + debt)) * cost_of_equity + \
+           (debt / (equity + debt)) * params['cost_of_debt'] * (1.0 - params['tax_rate'])
+
+
+def discount(u_fcf: np.ndarray, wacc: np.ndarray, growth: np.ndarray,
+             cash: np.ndarray, debt: np.ndarray, shares: np.ndarray) -> np.ndarray:
+    # Цена акции: дисконтированный UFCF + терминальная стоимость Гордона.
+    # u_fcf (..., years), остальное транслируется к форме (...)
+    wacc = np.asarray(wacc, dtype=float)
+    periods = np.arange(1, u_fcf.shape[-1] + 1)
+    pv_fcf = np.sum(u_fcf / (1.0 + wacc[..., None]) ** periods, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terminal_value = u_fcf[..., -1] * (1.0 + growth) / (wacc - growth)
+    pv_tv = terminal_value / (1.0 + wacc) ** u_fcf.shape[-1]
+    return (pv_fcf + pv_tv + cash - debt) / shares
+
+
+def value_many(inputs: list[Optional[dict]]) -> list[Optional[float]]:
+    # Справедливая цена для пачки тикеров за один проход, None для тикеров без оценки
+    ready = [i for i, item in enumerate(inputs) if item is not None]
+    prices: list[Optional[float]] = [None] * len(inputs)
+    if not ready:
+        return prices
+    params = estimate_params([inputs[i] for i in ready])
+    price = discount(project(params), get_wacc(params), params['terminal_growth'],
+                     params['cash'], params['debt'], params['shares'])
+    for i, value in zip(ready, price):
+        prices[i] = round(float(value), 2) if np.isfinite(value) else None
+    return prices
+
+
+# Сетка чувствительности: сдвиги WACC от расчётного и варианты темпа роста в терминальном периоде
+wacc_shifts: tuple = (-0.02, -0.01, 0.0, 0.01, 0.02)
+growth_grid: tuple = (0.015, 0.02, 0.025, 0.03, 0.035)
+
+
+def sensitivity(inputs: dict, shifts: tuple = wacc_shifts, growth_values: tuple = growth_grid) -> dict:
+    # Вся сетка WACC x g за один проход по уже спрогнозированному UFCF
+    params = estimate_params([inputs])
+    u_fcf = project(params)[0]
+    wacc = get_wacc(params)[0] + np.array(shifts)
+    growth = np.array(growth_values)
+    price = discount(u_fcf, wacc[:, None], growth[None, :], params['cash'][0], params['debt'][0], params['shares'][0])
+    valid = np.isfinite(price) & (wacc[:, None] > growth[None, :])
+    return {
+        'wacc': [round(float(item), 4) for item in wacc],
+        'growth': [round(float(item), 4) for item in growth],
+        'price': [[round(float(cell), 2) if is_valid else None for cell, is_valid in zip(row, valid_row)]
+                  for row, valid_row in zip(price, valid)]
+    }
+
+
+# Монте-Карло: сколько прогонов, размер порции и разброс (стандартное отклонение) драйверов вокруг точечных оценок
+mc_samples: int = 100000
+mc_chunk: int = 16384
+mc_spread: dict = {
+    'rev_g': 0.03,
+    'last_ebit_prc': 0.02,
+    'beta': 0.2,
+    'terminal_growth': 0.005
+}
+mc_percentiles: tuple = (5, 25, 50, 75, 95)
+mc_cache_size: int = 512
+mc_cache: OrderedDict = OrderedDict()
+mc_cache_lock = threading.Lock()
+
+
+def monte_carlo(inputs: dict, samples: int = mc_samples, chunk: int = mc_chunk,
+                seed: Optional[int] = None) -> Optional[dict]:
+    # Распределение справедливой цены: драйверы из mc_spread берутся нормально распределёнными,
+    # считается порциями по chunk прогонов, так что память не растёт вместе с промежуточными матрицами
+    base = {name: value[0] for name, value in estimate_params([inputs]).items()}
+    rng = np.random.default_rng(seed)
+    prices = np.empty(samples)
+    for start in range(0, samples, chunk):
+        count = min(chunk, samples - start)
+        params = dict(base)
+        for name, spread in mc_spread.items():
+            params[name] = rng.normal(base[name], spread, count)
+        wacc = get_wacc(params)
+        price = discount(project(params), wacc, params['terminal_growth'],
+                         base['cash'], base['debt'], base['shares'])
+        # Терминальная стоимость не определена, если рост не ниже ставки дисконтирования
+        price[wacc <= params['terminal_growth']] = np.nan
+        prices[start:start + count] = price
+
+    prices = prices[np.isfinite(prices)]
+    if not len(prices):
+        return None
+    bands = np.percentile(prices, mc_percentiles)
+    return {
+        'date': inputs['date'],
+        'samples': samples,
+        'valid': int(len(prices)),
+        'mean': round(float(prices.mean()), 2),
+        'percentiles': {str(p): round(float(band), 2) for p, band in zip(mc_percentiles, bands)}
+    }
+
+
+def monte_carlo_cached(ticker: str, inputs: dict, samples: int = mc_samples) -> Optional[dict]:
+    # Ключ - отпечаток самих входов: безрисковая ставка, бета, оценки аналитиков и квартальные данные
+    # меняются и между годовыми отчётами, дата отчёта их не покрывает
+    key = (ticker, hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest(), samples)
+    with mc_cache_lock:
+        if key in mc_cache:
+            mc_cache.move_to_end(key)
+            return mc_cache[key]
+    result = monte_carlo(inputs, samples)
+    with mc_cache_lock:
+        mc_cache[key] = result
+        while len(mc_cache) > mc_cache_size:
+            mc_cache.popitem(last=False)
+    return result
@@ -0,0 +1,117 @@
+import datetime
+import json
+import threading
+import time
+
+from os import path, replace
+from typing import Optional
+
+import network
+
+
+calendar_path: str = '\\FinancialData/filings.json'
+# Сколько доверять известной дате последнего отчёта без подтверждения из календаря или API
+max_staleness: float = 12 * 60 * 60
+refresh_interval: int = 6 * 60 * 60
+# FMP отдаёт календарь не больше чем за 3 месяца
+first_lookback_days: int = 90
+
+
+class FilingCalendar:
+    # Дата последнего отчёта по тикерам (та же, что возвращает network.get_last_report_data - конец периода),
+    # проверка «не вышел ли новый отчёт» - сравнение дат в памяти. Раз в refresh_interval весь календарь
+    # отчётностей за прошедшие дни забирается одним запросом; тикеры, которые есть в календаре FMP,
+    # подтверждаются этим запросом, остальные - отдельным запросом к API по истечении max_staleness
+    def __init__(self, _calendar_path: str = calendar_path, _max_staleness: float = max_staleness):
+        self.calendar_path = _calendar_path
+        self.max_staleness = _max_staleness
+        # ticker -> (дата последнего отчёта 'YYYY-MM-DD', когда её подтвердили)
+        self.dates: dict[str, tuple[str, float]] = {}
+        # Тикеры, которые встречались в календаре FMP: отсутствие новой записи для них значит «отчёта не было»
+        self.covered: set[str] = set()
+        self.last_refresh: Optional[str] = None
+        self.is_loaded = False
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'updated': 0}
+
+    def load(self) -> None:
+        with self.lock:
+            if self.is_loaded:
+                return
+            if path.exists(self.calendar_path):
+                data = json.load(open(self.calendar_path, 'rt'))
+                self.dates = {ticker: tuple(entry) for ticker, entry in data['dates'].items()}
+                self.covered = set(data['covered'])
+                self.last_refresh = data['last_refresh']
+            self.is_loaded = True
+
+    def save(self) -> None:
+        with self.lock:
+            data = {'dates': self.dates, 'covered': sorted(self.covered), 'last_refresh': self.last_refresh}
+        with open(f'{self.calendar_path}.tmp', 'wt') as file:
+            json.dump(data, file)
+        replace(f'{self.calendar_path}.tmp', self.calendar_path)
+
+    def record(self, ticker: str, report_date: str) -> None:
+        self.load()
+        with self.lock:
+            self.dates[ticker] = (report_date, time.time())
+
+    def last_report(self, ticker: str) -> Optional[str]:
+        # Без сети: None, если свежей даты нет
+        self.load()
+        with self.lock:
+            entry = self.dates.get(ticker)
+        if entry is None or time.time() - entry[1] > self.max_staleness:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return entry[0]
+
+    def report_date(self, ticker: str) -> str:
+        # Из календаря, а если там нет свежей даты - из API с записью в календарь
+        report_date = self.last_report(ticker)
+        if report_date is None:
+            report_date = network.get_last_report_data(ticker)
+            self.record(ticker, report_date)
+        return report_date
+
+    def is_stale(self, ticker: str, last_update: float) -> Optional[bool]:
+        # None - календарь про тикер ничего свежего не знает, нужно спросить API
+        report_date = self.last_report(ticker)
+        if report_date is None:
+            return None
+        return time.strptime(report_date, '%Y-%m-%d') > time.gmtime(last_update)
+
+    def refresh(self) -> None:
+        self.load()
+        today = datetime.datetime.utcnow().date()
+        if self.last_refresh is None:
+            from_date = today - datetime.timedelta(days=first_lookback_days)
+        else:
+            # С запасом в день: записи календаря FMP иногда появляются задним числом
+            from_date = datetime.date.fromisoformat(self.last_refresh) - datetime.timedelta(days=1)
+        rows = network.get_earnings_calendar(from_date.isoformat(), today.isoformat())
+        now = time.time()
+        with self.lock:
+            for row in rows:
+                ticker = row.get('symbol')
+                period_end = row.get('fiscalDateEnding')
+                # Будущие даты - только анонс, отчёта ещё нет
+                if not ticker or not period_end or row.get('date', '') > today.isoformat():
+                    continue
+                self.covered.add(ticker)
+                known = self.dates.get(ticker)
+                if known is None or period_end > known[0]:
+                    self.dates[ticker] = (period_end, now)
+                    self.stats['updated'] += 1
+            # Календарь за эти дни полный: у остальных покрытых тикеров нового отчёта не было
+            for ticker in self.covered:
+                if ticker in self.dates:
+                    self.dates[ticker] = (self.dates[ticker][0], now)
+            self.last_refresh = today.isoformat()
+            self.stats['refreshes'] += 1
+        self.save()
+
+
+calendar = FilingCalendar()
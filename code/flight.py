@@ -0,0 +1,46 @@
+import threading
+
+from typing import Any, Callable, Hashable, Optional
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    # Первый вызов по ключу выполняет работу, остальные, пришедшие до её окончания, ждут тот же результат
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: dict[Hashable, Call] = {}
+
+    def do(self, key: Hashable, func: Callable, *args, **kwargs) -> Any:
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = Call()
+                self.calls[key] = call
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self) -> int:
+        with self.lock:
+            return len(self.calls)
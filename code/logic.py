@@ -1,15 +1,28 @@
+import html
 import json
+import re
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from os.path import exists
+from typing import Optional
 from telegram.ext import MessageHandler, Filters, MessageFilter
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, Message, \
     ReplyKeyboardMarkup, Update, ReplyKeyboardRemove, Bot
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext, Dispatcher
 
 import analyzer
+import charts
+import filings
 import network
+import peers
+import prewarm
+import reports
+import screener
+import storage
+import symbols
+import users
+import workers
 
 
 # Для каждого языка своя группа биндов (в будущем свой диспатчер наверное, хз()
@@ -33,6 +46,29 @@ dispatcher: Dispatcher = updater.dispatcher
 lang_dict: dict = {}
 available_lang: dict = dict(en=u"\U0001F1EC" + u"\U0001F1E7",
                             ru=u"\U0001F1F7" + u"\U0001F1FA")
+# Отчёты строятся в отдельном пуле, чтобы долгий отчёт не держал /help и настройки других пользователей
+report_workers: int = 4
+report_queue_size: int = 16
+report_pool = workers.BoundedPool(report_workers, report_queue_size, name='report')
+prewarmer = prewarm.Prewarmer(bot_version)
+busy_text: dict = dict(en="The bot is busy right now, please try again in a minute",
+                       ru="Бот сейчас загружен, попробуйте повторить через минуту")
+# Список тикеров в одном сообщении: сколько максимум берём и сколько Company собираем одновременно
+watchlist_size: int = 10
+watchlist_workers: int = 5
+# Холодные сборки списка укладываются в ту часть лимита FMP, которую не занимает прогрев
+watchlist_limiter = workers.RateLimiter(prewarm.rate_limit * (1 - prewarm.rate_share))
+watchlist_text: dict = dict(en=dict(columns=('Ticker', 'Rate', 'P/E', 'P/S', 'DCF'), not_found="Not found: "),
+                            ru=dict(columns=('Тикер', 'Рейт', 'P/E', 'P/S', 'DCF'), not_found="Не найдены: "))
+# Подписи переключателей отчёта, которых ещё нет в language.json: номер в списке настроек -> подпись
+report_labels: dict = dict(en=dict(other={3: "DCF sensitivity grid", 4: "DCF Monte Carlo range",
+                                           5: "Percentile among peers"}),
+                           ru=dict(other={3: "Чувствительность DCF", 4: "Разброс DCF (Монте-Карло)",
+                                           5: "Перцентиль среди компаний"}))
+screen_text: dict = dict(en=dict(usage="Usage: /screen peRatioTTM<15 and dividendYieldTTM>0.03 sort base_rate desc top 10",
+                                 empty="No companies match the screen"),
+                         ru=dict(usage="Пример: /screen peRatioTTM<15 and dividendYieldTTM>0.03 sort base_rate desc top 10",
+                                 empty="Нет компаний, подходящих под условия"))
 key_words: list = [
     ["О боте", "План", "Обратная", "Финансовая", "Графики", "Отчёт", "Смена", "Закрыть"],
     ["About", "Roadmap", "Feedback", "Financial", "Charts", "Report", "Change", "Close"]
@@ -77,7 +113,10 @@ config_template = {
                     'other': [
                         True,
                         True,
-                        True
+                        True,
+                        False,  # DCF sensitivity
+                        False,  # DCF Monte Carlo
+                        False  # Percentile among peers
                     ],
                     'value_type': 0,
                     'dynamics': 0
@@ -91,11 +130,11 @@ config_template = {
                 }
         }
 
+configs = users.ConfigCache(config_template)
+
 def update_config(user_id: int, lang: str = '', work_mode: int = -1, chart=(-1, True), report=('heh', -1, True),
                   dynamics: int = False, value_type: bool = False) -> None:
-    file_path = f'\\Config/users/{str(user_id)}.json'
-    if exists(file_path):
-        config = json.load(open(file_path, "rt"))
+    def change(config: dict) -> None:
         if lang:
             config['language'] = lang
         if work_mode != -1:
@@ -110,41 +149,23 @@ def update_config(user_id: int, lang: str = '', work_mode: int = -1, chart=(-1,
             num = config['report']['value_type']
             num = num + 1 if num + 1 != 3 else 0
             config['report']['value_type'] = num
-    else:
-        # Задаём дефолтные настройки, уже три :)
-        config = config_template
 
-    json.dump(config, open(file_path, "wt"))
+    # Если конфига ещё нет, изменения применяются к дефолтным настройкам
+    configs.update(user_id, change)
+
+def get_settings(user_id: int) -> users.UserSettings:
+    # Если конфиг пропал, отдаются настройки по умолчанию
+    # + надо наверное уведомить и попросить заново настроить бота
+    return configs.get(user_id)
 
 def get_lang_code(user_id: int) -> str:
-    file_path = f'\\Config/users/{str(user_id)}.json'
-    if exists(file_path):
-        config = json.load(open(file_path, "rt"))
-        return config["language"]
-    else:
-        # Если по какой-то причине конфиг пропал, создаём новый
-        # + надо наверное уведомить и попросить заново настроить бота
-        return "en"
+    return get_settings(user_id).language
 
 def get_work_mode(user_id: int) -> int:
-    file_path = f'\\Config/users/{str(user_id)}.json'
-    if exists(file_path):
-        config = json.load( open(file_path, "rt"))
-        return config["work_mode"]
-    else:
-        # Если по какой-то причине конфиг пропал, создаём новый
-        # + надо наверное уведомить и попросить заново настроить бота
-        return 0
+    return get_settings(user_id).work_mode
 
 def get_config(user_id: int) -> dict:
-    file_path = f'\\Config/users/{str(user_id)}.json'
-    if exists(file_path):
-        config = json.load(open(file_path, "rt"))
-        return config
-    else:
-        # Если по какой-то причине конфиг пропал, создаём новый
-        # + надо наверное уведомить и попросить заново настроить бота
-        return config_template
+    return get_settings(user_id).raw
 
 
 # Main functions
@@ -226,14 +247,18 @@ report_types = [
 def generate_report_config_keyboard(update: Update, type_num: int) -> tuple[str, InlineKeyboardMarkup]:
     if type_num == len(report_types):  # Обновляем, если в конце списка типов
         type_num = 0
-    lang_code = get_lang_code(update.effective_user.id)
+    settings = get_settings(update.effective_user.id)
+    lang_code = settings.language
     report_dict = lang_dict[lang_code]['settings']['report']
     type_dict = report_dict[report_types[type_num]]
-    config = get_config(update.effective_user.id)['report']
+    config = settings.report
 
     keyboard = [[InlineKeyboardButton(type_dict['name'], callback_data='c_r' + 't' + str(type_num))]]
+    extra_labels = report_labels[lang_code].get(report_types[type_num], {})
+    labels = list(type_dict['data']) + [extra_labels.get(i, str(i + 1)) for i in
+                                        range(len(type_dict['data']), len(config[report_types[type_num]]))]
     for conf, text, i in zip(config[report_types[type_num]],
-                             type_dict['data'],
+                             labels,
                              range(len(config))):
         smile = u"\U00002705" if conf else u"\U0000274C"
         keyboard.append([InlineKeyboardButton(f'{text} {smile}', callback_data='c_r' + str(i + 1) + str(type_num))])
@@ -343,7 +368,8 @@ class TickerFilter(MessageFilter):
     def filter(self, message: Message) -> bool:
         for char in message.text:
             char_code = ord(char)
-            if (char_code >= 65) & (char_code <= 90) | (char_code == 32):
+            # Кроме букв пробел, запятая и перенос строки - для списка тикеров
+            if (char_code >= 65) & (char_code <= 90) | (char_code in (10, 32, 44)):
                 pass
             else:
                 for lang_words in key_words:
@@ -352,35 +378,66 @@ class TickerFilter(MessageFilter):
                             return False
                 bad_ticker_format(message.chat, message.from_user.id, message.text)
                 return False
-        if network.check_ticker(message.text):
-            return True
-        else:
-            ticker_not_found(message.chat, message.from_user.id)
-            return False
+        # Наличие тикера проверяется уже в analyze_ticker, фильтр не ходит в сеть
+        return True
 
 def ticker_not_found(chat, user_id: int) -> None:
     chat.send_message(lang_dict[get_lang_code(user_id)]['bad_ticker']['not_found'])
 
 def bad_ticker_format(chat, user_id: int, text: str) -> None:
-    lang_code = get_lang_code(user_id)
-    work_mode = get_work_mode(user_id)
+    settings = get_settings(user_id)
+    lang_code = settings.language
+    work_mode = settings.work_mode
     chat.send_message(lang_dict[lang_code]['bad_ticker']['text'] +
                       lang_dict[lang_code]['bad_ticker']['formats'][work_mode])
     log_file = open('\\log.txt', 'at', encoding='utf-8')
     log_file.write(f'{time.strftime("%Y-%m-%d %X")}; user: {user_id}; text: {text};\n')
     log_file.close()
 
+def parse_tickers(text: str) -> list[str]:
+    # Повторы убираются с сохранением порядка
+    return list(dict.fromkeys(ticker for ticker in re.split(r'[\s,]+', text) if ticker))
+
 def determine_req_type(update: Update, context: CallbackContext) -> None:
-    analyze_ticker(update.effective_chat, update.effective_user.id, update.message.text)
+    tickers = parse_tickers(update.message.text)
+    if not tickers:
+        return
+    if len(tickers) == 1:
+        func, arg = analyze_ticker, tickers[0]
+    else:
+        func, arg = analyze_watchlist, tickers[:watchlist_size]
+    if report_pool.submit(func, update.effective_chat, update.effective_user.id, arg) is None:
+        report_busy(update.effective_chat, update.effective_user.id)
+
+def report_busy(chat, user_id: int) -> None:
+    lang_code = get_lang_code(user_id)
+    chat.send_message(lang_dict[lang_code].get('busy', busy_text[lang_code]))
 
 def analyze_ticker(chat, user_id: int, ticker: str) -> None:
-    config = get_config(user_id)
-    company = analyzer.Company(ticker, bot_version, config['report']['dynamics'])
-    report = company.generate_report(get_config(user_id), lang_dict[get_lang_code(user_id)]['report'])
+    if not symbols.index.resolve(ticker):
+        ticker_not_found(chat, user_id)
+        return
+    settings = get_settings(user_id)
+    # Тот же отчёт с теми же настройками уже собирали и данные с тех пор не менялись - Company не нужна
+    cached = reports.cache.get(ticker, settings.language, settings.report)
+    if cached is not None:
+        name, report = cached['name'], cached['report']
+    else:
+        company = analyzer.get_view(ticker, bot_version) or \
+            analyzer.get_company(ticker, bot_version, settings.dynamics)
+        name = company.ticker['name']
+        report = company.generate_report(settings.raw, lang_dict[settings.language]['report'])
+        reports.cache.put(ticker, settings.language, settings.report, company.report_version, name, report)
     # Отчёт может быть и без графика, или же с массивом графиков
-    if config['chart']['data'][0]:
-        plot_path = company.generate_chart()
-        chat.send_photo(open(plot_path, 'rb'), caption=report)
+    if settings.show_chart:
+        key = analyzer.generate_chart(ticker, name, settings.timeseries)
+        file_id = charts.cache.file_id(key)
+        if file_id is not None:
+            # Telegram уже хранит этот PNG, повторно не загружаем
+            chat.send_photo(file_id, caption=report)
+        else:
+            message = chat.send_photo(open(charts.cache.path(key), 'rb'), caption=report)
+            charts.cache.set_file_id(key, message.photo[-1].file_id)
     else:
         chat.send_message(report)
     """
@@ -390,6 +447,74 @@ def analyze_ticker(chat, user_id: int, ticker: str) -> None:
     ])
     """
 
+def analyze_watchlist(chat, user_id: int, tickers: list[str]) -> None:
+    settings = get_settings(user_id)
+    text_dict = lang_dict[settings.language].get('watchlist', watchlist_text[settings.language])
+    views = {ticker: analyzer.get_view(ticker, bot_version) for ticker in tickers}
+    cold = [ticker for ticker, view in views.items() if view is None]
+    if cold:
+        # Профили холодных тикеров одним запросом, облигации и премия за риск один раз на весь список:
+        # дальше resolve и параллельные сборки берут их из кэша ответов, а не ходят в сеть каждый сам
+        # Если пакетный запрос не прошёл, профили подтянут по одному resolve и download_data
+        try:
+            network.get_profiles(cold)
+        except Exception:
+            pass
+        try:
+            network.prefetch_shared()
+        except Exception:
+            pass
+
+    def build(ticker: str) -> Optional[dict]:
+        if views[ticker] is not None:
+            return views[ticker].ticker
+        if not symbols.index.resolve(ticker):
+            return None
+        try:
+            watchlist_limiter.acquire(prewarm.requests_per_estimate)
+            return analyzer.get_company(ticker, bot_version, settings.dynamics).ticker
+        except Exception:
+            # Один сломанный тикер не должен ронять всю таблицу
+            return None
+
+    # Время ответа - самый медленный тикер, а не сумма
+    with ThreadPoolExecutor(max_workers=min(len(tickers), watchlist_workers)) as executor:
+        results = dict(zip(tickers, executor.map(build, tickers)))
+
+    def cell(value) -> str:
+        return 'n/a' if value is None else str(round(value, 2))
+
+    rows = [text_dict['columns']]
+    for ticker, data in results.items():
+        if data is not None:
+            indicators = data['indicators']
+            rows.append((ticker, cell(data['base_rate']), cell(indicators.get('peRatioTTM')),
+                         cell(indicators.get('priceToSalesRatioTTM')), cell(data['dcf'])))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = ['  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows]
+    missing = [ticker for ticker, data in results.items() if data is None]
+    text = '\n'.join(lines)
+    if missing:
+        text += f'\n\n{text_dict["not_found"]}{", ".join(missing)}'
+    chat.send_message(f'<pre>{html.escape(text)}</pre>', parse_mode='HTML')
+
+# Screener
+def screen(update: Update, context: CallbackContext) -> None:
+    # Только по уже посчитанным тикерам из peers.matrix, в сеть не ходит, поэтому не через report_pool
+    lang_code = get_lang_code(update.effective_user.id)
+    text_dict = lang_dict[lang_code].get('screen', screen_text[lang_code])
+    try:
+        rows = screener.screen(' '.join(context.args))
+    except ValueError as error:
+        update.effective_chat.send_message(f'{error}\n{text_dict["usage"]}')
+        return
+    if not rows:
+        update.effective_chat.send_message(text_dict['empty'])
+        return
+    lines = [f'{ticker}: ' + ', '.join(f'{name}={round(value, 3)}' for name, value in values.items())
+             for ticker, values in rows]
+    update.effective_chat.send_message('\n'.join(lines))
+
 # Base
 def bind_handlers() -> None:
     dispatcher.add_handler(CallbackQueryHandler(report_config_selected, pattern='c_r'), 0)
@@ -403,6 +528,7 @@ def bind_handlers() -> None:
     dispatcher.add_handler(CommandHandler('info', info_menu), 0)
     dispatcher.add_handler(CommandHandler('help', send_help), 0)
     dispatcher.add_handler(CommandHandler('start', start), 0)
+    dispatcher.add_handler(CommandHandler('screen', screen), 0)
 
     dispatcher.add_handler(MessageHandler(Filters.user(admin_id) & Filters.text("/clear"), clear), 0)
     dispatcher.add_handler(MessageHandler(Filters.text & TickerFilter(), determine_req_type), 0)
@@ -419,9 +545,31 @@ def bind_handlers() -> None:
 
     dispatcher.add_handler(MessageHandler(~Filters.text, no_context_message), len(dispatcher.handlers))
 
+def refresh_symbols(context: CallbackContext) -> None:
+    symbols.index.refresh()
+
+def refresh_filings(context: CallbackContext) -> None:
+    filings.calendar.refresh()
+
+def run_prewarm(context: CallbackContext) -> None:
+    # Проход долгий, поэтому в своём потоке, а не в потоке JobQueue
+    prewarmer.start()
+
+def load_peers(context: CallbackContext) -> None:
+    # Матрица читается из хранилища один раз, чтобы первый /screen не ждал загрузки
+    peers.matrix.load()
+
 def start_telegram_bot() -> None:
+    # Доводим коммиты дерева json, прерванные прошлым падением, до того как кто-то начнёт писать
+    storage.TreeStore().recover()
+    # Пул графиков - до запуска потоков updater и job queue
+    charts.renderer.start()
     upload_dict()
     bind_handlers()
+    updater.job_queue.run_repeating(refresh_symbols, interval=symbols.refresh_interval, first=0)
+    updater.job_queue.run_once(load_peers, when=0)
+    updater.job_queue.run_repeating(refresh_filings, interval=filings.refresh_interval, first=0)
+    updater.job_queue.run_repeating(run_prewarm, interval=prewarm.check_interval, first=60)
     updater.start_webhook(listen='0.0.0.0',
                           port=443,
                           url_path=orig_bot_token,
@@ -1,6 +1,6 @@
-from logic import start_telegram_bot
-
 if __name__ == '__main__':
+    # Импорт внутри: воркеры графиков запускаются через spawn и импортируют main заново
+    from logic import start_telegram_bot
     try:
         start_telegram_bot()
     except Exception as exc:
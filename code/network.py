@@ -1,9 +1,17 @@
 import certifi
 import datetime
 import json
+import ssl
+import threading
+import time
 
-from typing import Union
-from urllib.request import urlopen
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from queue import Empty, Full, LifoQueue
+from typing import Optional, Union
+from urllib.error import HTTPError
+from urllib.parse import parse_qsl, urlsplit
 
 
 api_key = 'api'
@@ -23,23 +31,183 @@ requests = [
     "rating"
 ]
 
-def download_data(ticker: str) -> list[Union[list, dict]]:
-    data_arr = []
+# Настройки общего HTTP клиента
+pool_size = 10  # соединений на хост, под параллельный download_data
+timeout = 15.0
+
+
+class HttpClient:
+    # Пул keep-alive соединений по хостам, чтобы не платить за TCP и TLS на каждый запрос
+    def __init__(self, _pool_size: int = pool_size, _timeout: float = timeout):
+        self.pool_size = _pool_size
+        self.timeout = _timeout
+        self.ssl_context = ssl.create_default_context(cafile=certifi.where())
+        self.pools: dict[tuple[str, str], LifoQueue] = {}
+        self.lock = threading.Lock()
+
+    def get_pool(self, scheme: str, host: str) -> LifoQueue:
+        with self.lock:
+            if (scheme, host) not in self.pools:
+                self.pools[(scheme, host)] = LifoQueue(maxsize=self.pool_size)
+            return self.pools[(scheme, host)]
+
+    def connect(self, scheme: str, host: str) -> HTTPConnection:
+        if scheme == 'https':
+            return HTTPSConnection(host, timeout=self.timeout, context=self.ssl_context)
+        return HTTPConnection(host, timeout=self.timeout)
+
+    def get(self, url: str) -> bytes:
+        parts = urlsplit(url)
+        target = f'{parts.path}?{parts.query}' if parts.query else parts.path
+        pool = self.get_pool(parts.scheme, parts.netloc)
+        try:
+            conn, is_reused = pool.get_nowait(), True
+        except Empty:
+            conn, is_reused = self.connect(parts.scheme, parts.netloc), False
+        try:
+            try:
+                conn.request('GET', target, headers={'Connection': 'keep-alive'})
+                response = conn.getresponse()
+            except (HTTPException, ConnectionError):
+                # Сервер мог закрыть простаивающее соединение, пробуем один раз заново
+                conn.close()
+                if not is_reused:
+                    raise
+                conn = self.connect(parts.scheme, parts.netloc)
+                conn.request('GET', target, headers={'Connection': 'keep-alive'})
+                response = conn.getresponse()
+            body = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            try:
+                pool.put_nowait(conn)
+            except Full:
+                conn.close()
+        if response.status != 200:
+            raise HTTPError(url, response.status, response.reason, response.headers, None)
+        return body
+
+    def close(self) -> None:
+        with self.lock:
+            for pool in self.pools.values():
+                while not pool.empty():
+                    pool.get_nowait().close()
+            self.pools.clear()
+
+
+client = HttpClient()
+
+# Время жизни ответов по семействам эндпоинтов, в секундах
+hour = 60 * 60
+cache_size = 2048
+cache_ttl = {
+    'treasury': 24 * hour,
+    'market_risk_premium': 24 * hour,
+    'profile': 6 * hour,
+    # Отчётность меняется только с новым квартальным отчётом: её сбрасывает invalidate(ticker),
+    # срок здесь лишь страховка, если новый отчёт так и не заметили
+    'statement': 100 * 24 * hour,
+    'last_report': hour,
+    'default': hour
+}
+statement_endpoints = set(sp_requests) | {'analyst-estimates'}
+
+
+class ResponseCache:
+    # TTL + LRU кэш сырых ответов, ключ - эндпоинт и параметры без api ключа
+    def __init__(self, _maxsize: int = cache_size, _ttl: dict = None):
+        self.maxsize = _maxsize
+        self.ttl = dict(cache_ttl if _ttl is None else _ttl)
+        self.entries: OrderedDict[tuple, tuple[float, Optional[str], bytes]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    @staticmethod
+    def parse(url: str) -> tuple[tuple, str, Optional[str]]:
+        parts = urlsplit(url)
+        params = tuple(sorted((k, v) for k, v in parse_qsl(parts.query) if k != 'apikey'))
+        segments = [seg for seg in parts.path.split('/') if seg]
+        # /api/v3/<endpoint>/<ticker> или /api/v4/<endpoint>
+        endpoint = segments[2] if len(segments) > 2 else parts.path
+        ticker = segments[3] if len(segments) > 3 else None
+        if endpoint in statement_endpoints:
+            family = 'last_report' if endpoint == 'income-statement' and ('limit', '1') in params \
+                else 'statement'
+        elif endpoint in ('treasury', 'market_risk_premium', 'profile'):
+            family = endpoint
+        else:
+            family = 'default'
+        return (parts.path, params), family, ticker
+
+    def get(self, url: str) -> Optional[bytes]:
+        key, _, _ = self.parse(url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[2]
+
+    def put(self, url: str, body: bytes) -> None:
+        key, family, ticker = self.parse(url)
+        expires = time.monotonic() + self.ttl.get(family, self.ttl['default'])
+        with self.lock:
+            self.entries[key] = (expires, ticker, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, ticker: str) -> None:
+        # Вызывается, когда у тикера вышел новый отчёт
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[1] == ticker]:
+                del self.entries[key]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+cache = ResponseCache()
+
+def download_data(ticker: str, max_workers: int = len(sp_requests) + len(requests)) -> list[Union[list, dict]]:
+    # Порядок результата важен: по нему индексируется analyzer.DataType
     req_body = 'https://financialmodelingprep.com/api/v3/'
     limit = 10
-    for sp_req in sp_requests:
-        url = f'{req_body}{sp_req}/{ticker}?period=quarter&limit={limit}&apikey={api_key}'
+    jobs = [(sp_req, f'{req_body}{sp_req}/{ticker}?period=quarter&limit={limit}&apikey={api_key}', False)
+            for sp_req in sp_requests]
+    jobs += [(req, f'{req_body}{req}/{ticker}?apikey={api_key}', True) for req in requests]
+
+    def fetch(job: tuple[str, str, bool]) -> Union[list, dict]:
+        name, url, is_single = job
         data = execute_url(url)
-        json.dump(data, open(f'\\FinancialData/Storage/{sp_req}.json', 'wt'))
-        data_arr.append(data)
-    for req in requests:
-        url = f'{req_body}{req}/{ticker}?apikey={api_key}'
-        data = execute_url(url)[0]
-        json.dump(data, open(f'\\FinancialData/Storage/{req}.json', 'wt'))
-        data_arr.append(data)
-    return data_arr
+        if is_single:
+            data = data[0]
+        json.dump(data, open(f'\\FinancialData/Storage/{name}.json', 'wt'))
+        return data
+
+    if max_workers <= 1:
+        return [fetch(job) for job in jobs]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        return list(executor.map(fetch, jobs))
 
 
+def get_symbol_list() -> list:
+    # Список всех торгуемых символов FMP, несколько мегабайт - мимо кэша ответов
+    return execute_url(f'https://financialmodelingprep.com/api/v3/stock/list?apikey={api_key}', use_cache=False)
+
 def check_ticker(ticker: str) -> bool:
     return True if execute_url(f'https://financialmodelingprep.com/api/v3/profile/{ticker}?apikey={api_key}') else False
 
@@ -47,15 +215,44 @@ def get_last_report_data(ticker: str) -> str:
     url = f'https://financialmodelingprep.com/api/v3/income-statement/{ticker}?period=quarter&apikey={api_key}&limit=1'
     return execute_url(url)[0]["date"]
 
+def get_earnings_calendar(from_date: str, to_date: str) -> list:
+    # Отчётности всех компаний за период (не больше 3 месяцев), для filings.calendar
+    url = f'https://financialmodelingprep.com/api/v3/earning_calendar?' \
+          f'from={from_date}&to={to_date}&apikey={api_key}'
+    return execute_url(url, use_cache=False)
+
 def get_profile(ticker: str) -> dict:
     url = f'https://financialmodelingprep.com/api/v3/profile/{ticker}?apikey={api_key}'
     return execute_url(url)[0]
 
+def get_profiles(tickers: list[str]) -> dict[str, dict]:
+    # Один запрос на несколько тикеров (FMP принимает символы через запятую). Профиль каждого кладётся в кэш
+    # под url одиночного запроса, так что check_ticker, get_profile и download_data дальше берут его оттуда
+    req_body = 'https://financialmodelingprep.com/api/v3/profile/'
+    profiles = {item['symbol']: item
+                for item in execute_url(f'{req_body}{",".join(tickers)}?apikey={api_key}', use_cache=False)}
+    for ticker in tickers:
+        # Неизвестный символ FMP отдаёт пустым списком, так же и кэшируем
+        body = json.dumps([profiles[ticker]] if ticker in profiles else []).encode('utf-8')
+        cache.put(f'{req_body}{ticker}?apikey={api_key}', body)
+    return profiles
+
+def prefetch_shared() -> None:
+    # Облигации и премия за риск одни на все тикеры: загружаем до параллельных сборок, чтобы те взяли их из кэша
+    get_last_treasury()
+    execute_url(f'https://financialmodelingprep.com/api/v4/market_risk_premium?apikey={api_key}')
+
 def get_chart(ticker: str, days_count: int) -> list:
     url = f'https://financialmodelingprep.com/api/v3/historical-price-full/{ticker}?' \
           f'serietype=line&timeseries={days_count}&apikey={api_key}'
     return execute_url(url)["historical"]
 
+def get_chart_since(ticker: str, from_date: str) -> list:
+    # Только закрытия начиная с from_date, история уже лежит в prices.store, поэтому мимо кэша
+    url = f'https://financialmodelingprep.com/api/v3/historical-price-full/{ticker}?' \
+          f'serietype=line&from={from_date}&apikey={api_key}'
+    return execute_url(url, use_cache=False).get("historical", [])
+
 def get_last_treasury() -> dict:
     today = datetime.datetime.today()
     risk_free_url = f'https://financialmodelingprep.com/api/v4/treasury?' \
@@ -80,8 +277,13 @@ def get_dcf_data(ticker: str) -> tuple[float, list, list, list, list, list, dict
     ev = execute_url(ev_url)
     return get_last_treasury()['year10'] / 100, market_premium, estimates, income, cashflow, balance, ev
 
-def execute_url(url: str) -> Union[list, dict]:
-    response = urlopen(url, cafile=certifi.where())
-    data = json.loads(response.read().decode('utf-8'))
+def execute_url(url: str, use_cache: bool = True) -> Union[list, dict]:
+    # В кэше лежат байты ответа, так что каждый вызов получает свою копию данных
+    body = cache.get(url) if use_cache else None
+    if body is None:
+        body = client.get(url)
+        if use_cache:
+            cache.put(url, body)
+    data = json.loads(body.decode('utf-8'))
     return data
 
@@ -0,0 +1,132 @@
+import threading
+
+from typing import Optional
+
+import numpy as np
+
+import storage
+
+
+def ticker_values(data: dict) -> dict[str, Optional[float]]:
+    # Колонки матрицы: base_rate, dcf и все indicators тикера
+    return {'base_rate': data['base_rate'], 'dcf': data.get('dcf'), **data['indicators']}
+
+
+class IndicatorMatrix:
+    # Показатели всех тикеров в одной матрице float (строка - тикер, колонка - показатель)
+    # и списки строк по индустриям и секторам: медианы, перцентили и z-оценки по пирам - векторно
+    def __init__(self):
+        self.columns: dict[str, int] = {}
+        self.rows: dict[str, int] = {}
+        self.names: list[str] = []
+        self.values = np.full((0, 0), np.nan)
+        self.groups: dict[tuple[str, str], list[int]] = {}
+        self.ticker_groups: dict[str, tuple[str, str]] = {}
+        self.free_rows: list[int] = []
+        self.is_loaded = False
+        self.lock = threading.RLock()
+
+    def load(self) -> 'IndicatorMatrix':
+        with self.lock:
+            if not self.is_loaded:
+                for sector, industry, ticker, data in storage.store.iter_tickers():
+                    self.upsert(ticker, sector, industry, data)
+                self.is_loaded = True
+        return self
+
+    def reserve(self, rows: int, columns: int) -> None:
+        # Ёмкость растёт удвоением, так что добавление тикера - амортизированное O(1)
+        height, width = self.values.shape
+        if rows <= height and columns <= width:
+            return
+        grown = np.full((max(rows, height * 2, 64), max(columns, width)), np.nan)
+        grown[:height, :width] = self.values
+        self.values = grown
+
+    def upsert(self, ticker: str, sector: str, industry: str, data: dict) -> None:
+        values = ticker_values(data)
+        with self.lock:
+            for name in values:
+                if name not in self.columns:
+                    self.columns[name] = len(self.columns)
+            if ticker in self.rows:
+                row = self.rows[ticker]
+                self.leave_groups(ticker, row)
+            else:
+                row = self.free_rows.pop() if self.free_rows else len(self.names)
+                if row == len(self.names):
+                    self.names.append(ticker)
+                else:
+                    self.names[row] = ticker
+                self.rows[ticker] = row
+            self.reserve(len(self.names), len(self.columns))
+            self.values[row] = np.nan
+            for name, value in values.items():
+                if value is not None:
+                    self.values[row, self.columns[name]] = value
+            self.ticker_groups[ticker] = (sector, industry)
+            self.groups.setdefault(('sector', sector), []).append(row)
+            self.groups.setdefault(('industry', industry), []).append(row)
+
+    def leave_groups(self, ticker: str, row: int) -> None:
+        sector, industry = self.ticker_groups.pop(ticker)
+        self.groups[('sector', sector)].remove(row)
+        self.groups[('industry', industry)].remove(row)
+
+    def remove(self, ticker: str) -> None:
+        with self.lock:
+            row = self.rows.pop(ticker, None)
+            if row is not None:
+                self.leave_groups(ticker, row)
+                self.values[row] = np.nan
+                self.free_rows.append(row)
+
+    def column(self, name: str, kind: str, group: str) -> np.ndarray:
+        # Значения показателя по группе без пропусков; kind - 'industry' или 'sector'
+        rows = self.groups.get((kind, group), [])
+        if name not in self.columns or not rows:
+            return np.empty(0)
+        values = self.values[rows, self.columns[name]]
+        return values[~np.isnan(values)]
+
+    def peer_group(self, ticker: str, kind: str) -> str:
+        sector, industry = self.ticker_groups[ticker]
+        return industry if kind == 'industry' else sector
+
+    def value(self, ticker: str, name: str) -> Optional[float]:
+        if ticker not in self.rows or name not in self.columns:
+            return None
+        value = self.values[self.rows[ticker], self.columns[name]]
+        return None if np.isnan(value) else float(value)
+
+    def median(self, name: str, kind: str, group: str) -> Optional[float]:
+        values = self.column(name, kind, group)
+        return float(np.median(values)) if len(values) else None
+
+    def percentile(self, name: str, kind: str, group: str, q: float) -> Optional[float]:
+        values = self.column(name, kind, group)
+        return float(np.percentile(values, q)) if len(values) else None
+
+    def percentile_rank(self, ticker: str, name: str, kind: str = 'industry') -> Optional[tuple[int, int]]:
+        # Доля пиров (в процентах) со значением не выше, чем у тикера, и число пиров с данными
+        with self.lock:
+            value = self.value(ticker, name)
+            if value is None:
+                return None
+            values = self.column(name, kind, self.peer_group(ticker, kind))
+        if len(values) < 2:
+            return None
+        return round(100.0 * np.count_nonzero(values <= value) / len(values)), len(values)
+
+    def zscore(self, ticker: str, name: str, kind: str = 'industry') -> Optional[float]:
+        with self.lock:
+            value = self.value(ticker, name)
+            if value is None:
+                return None
+            values = self.column(name, kind, self.peer_group(ticker, kind))
+        if len(values) < 2 or values.std() == 0.0:
+            return None
+        return float((value - values.mean()) / values.std())
+
+
+matrix = IndicatorMatrix()
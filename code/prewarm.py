@@ -0,0 +1,75 @@
+import threading
+import time
+import traceback
+
+import analyzer
+import filings
+import storage
+
+
+# Лимит тарифа FMP, запросов в минуту; прогрев берёт себе только его часть, остальное - пользователям
+rate_limit: int = 300
+rate_share: float = 0.5
+# download_data, get_dcf_data, профиль и облигации на одну переоценку
+requests_per_estimate: int = 19
+check_interval: int = 6 * 60 * 60
+
+
+class Prewarmer:
+    # Ищет тикеры, у которых вышел отчёт новее lastUpdate, и переоценивает их в фоне,
+    # чтобы пользовательский запрос попал на уже свежие данные
+    def __init__(self, bot_version: str, _rate_limit: int = rate_limit):
+        self.bot_version = bot_version
+        self.rate_limit = _rate_limit
+        self.lock = threading.Lock()
+        self.stats = {'checked': 0, 'updated': 0, 'errors': 0, 'last_run': 0.0}
+
+    def pace(self, requests_count: int) -> None:
+        time.sleep(requests_count * 60.0 / (self.rate_limit * rate_share))
+
+    def is_stale(self, ticker: str, meta: dict) -> bool:
+        if self.bot_version > meta['version']:
+            return True
+        is_stale = filings.calendar.is_stale(ticker, meta['lastUpdate'])
+        if is_stale is not None:
+            return is_stale
+        # Календарь о тикере не знает: один запрос к API, он же попадёт в календарь
+        last_report = time.strptime(filings.calendar.report_date(ticker), '%Y-%m-%d')
+        self.pace(1)
+        return last_report > time.gmtime(meta['lastUpdate'])
+
+    def find_stale(self) -> list[str]:
+        stale = []
+        # Сначала забираем весь список, чтобы не держать чтение из хранилища открытым на время пауз
+        for ticker, meta in list(storage.store.iter_meta()):
+            try:
+                if self.is_stale(ticker, meta):
+                    stale.append(ticker)
+            except Exception:
+                self.stats['errors'] += 1
+            self.stats['checked'] += 1
+        return stale
+
+    def run(self) -> None:
+        if not self.lock.acquire(blocking=False):
+            return  # предыдущий проход ещё идёт
+        try:
+            for ticker in self.find_stale():
+                try:
+                    # Через get_company: пользователь, запросивший тот же тикер, дождётся этой же сборки
+                    analyzer.get_company(ticker, self.bot_version)
+                    self.stats['updated'] += 1
+                except Exception:
+                    self.stats['errors'] += 1
+                    log_file = open('\\log.txt', 'at', encoding='utf-8')
+                    log_file.write(f'{time.strftime("%Y-%m-%d %X")}; prewarm {ticker}: {traceback.format_exc()}\n')
+                    log_file.close()
+                self.pace(requests_per_estimate)
+            self.stats['last_run'] = time.time()
+        finally:
+            self.lock.release()
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, name='prewarm', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+import network
+from charts import last_trading_date
+
+
+prices_path: str = '\\FinancialData/Prices/'
+# Первая загрузка берёт историю с запасом (~5 торговых лет), чтобы смена chart.timeseries не требовала перезагрузки
+initial_days: int = 1260
+# Запись файла: день от 1970-01-01 и цена закрытия, 12 байт без выравнивания
+# Закрытие последней сессии провайдер публикует с задержкой: пока его нет, повторяем не чаще раза в retry_interval
+retry_interval: float = 15 * 60
+# Дельта запрашивается с перекрытием в несколько уже сохранённых сессий: close у FMP скорректирован на сплиты,
+# и после сплита или пересчёта истории перекрытие не совпадёт - тогда история перезагружается целиком
+overlap_sessions: int = 3
+record = np.dtype([('day', '<i4'), ('close', '<f8')])
+
+
+def to_records(rows: list[dict]) -> np.ndarray:
+    # Ответ FMP (от новых к старым) -> записи от старых к новым
+    records = np.empty(len(rows), dtype=record)
+    records['day'] = np.array([row['date'] for row in rows], dtype='datetime64[D]').astype('<i4')
+    records['close'] = [row['close'] for row in rows]
+    return records[np.argsort(records['day'], kind='stable')]
+
+
+class PriceStore:
+    # Закрытия тикера в бинарном файле, отсортированные по дню. Новые сессии только дописываются в конец
+    # (из сети берётся лишь дельта с последнего сохранённого дня), окно - срез memmap без копирования
+    def __init__(self, _prices_path: str = prices_path):
+        self.prices_path = _prices_path
+        # Глубина полной загрузки в этом процессе: у молодых тикеров история короче окна, перезагружать её незачем
+        self.depths: dict[str, int] = {}
+        # Торговый день, до которого данные уже есть. Пока закрытия нет (не опубликовано или праздник),
+        # день не отмечается, а следующий запрос откладывается до retry_at
+        self.checked: dict[str, str] = {}
+        self.retry_at: dict[str, float] = {}
+        self.locks: dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
+        self.stats = {'full': 0, 'delta': 0, 'fresh': 0, 'appended': 0, 'rescaled': 0}
+
+    def file_path(self, ticker: str) -> str:
+        return f'{self.prices_path}{ticker}.bin'
+
+    def ticker_lock(self, ticker: str) -> threading.Lock:
+        with self.lock:
+            return self.locks.setdefault(ticker, threading.Lock())
+
+    def load(self, ticker: str) -> np.ndarray:
+        file_path = self.file_path(ticker)
+        count = os.path.getsize(file_path) // record.itemsize if os.path.exists(file_path) else 0
+        if count == 0:
+            return np.empty(0, dtype=record)
+        # Недописанный хвост (упали посреди append) в окно не попадает
+        return np.memmap(file_path, dtype=record, mode='r', shape=(count,))
+
+    def write(self, ticker: str, records: np.ndarray) -> None:
+        file_path = self.file_path(ticker)
+        os.makedirs(self.prices_path, exist_ok=True)
+        with open(f'{file_path}.tmp', 'wb') as file:
+            file.write(records.tobytes())
+        os.replace(f'{file_path}.tmp', file_path)
+
+    def append(self, ticker: str, records: np.ndarray) -> None:
+        with open(self.file_path(ticker), 'r+b') as file:
+            # Отрезаем недописанную запись, иначе всё дальше съедет
+            size = file.seek(0, os.SEEK_END)
+            file.truncate(size - size % record.itemsize)
+            file.seek(0, os.SEEK_END)
+            file.write(records.tobytes())
+
+    def update(self, ticker: str, days: int) -> None:
+        with self.ticker_lock(ticker):
+            target = last_trading_date()
+            stored = self.load(ticker)
+            if len(stored) < days and self.depths.get(ticker, 0) < days:
+                del stored
+                self.reload(ticker, target, max(days, initial_days))
+                return
+            if self.checked.get(ticker) == target or not len(stored) or \
+                    time.time() < self.retry_at.get(ticker, 0.0) or self.mark(ticker, target, stored):
+                self.stats['fresh'] += 1
+                return
+            last_day = int(stored['day'][-1])
+            overlap = np.array(stored[-overlap_sessions:])
+            depth = max(len(stored), days, initial_days)
+            del stored
+            records = to_records(network.get_chart_since(ticker, str(np.datetime64(int(overlap['day'][0]), 'D'))))
+            if len(records) and not self.matches(overlap, records):
+                self.reload(ticker, target, depth)
+                self.stats['rescaled'] += 1
+                return
+            records = records[records['day'] > last_day]
+            if len(records):
+                self.append(ticker, records)
+                self.stats['appended'] += len(records)
+            self.mark(ticker, target, self.load(ticker))
+            self.stats['delta'] += 1
+
+    def reload(self, ticker: str, target: str, depth: int) -> None:
+        records = to_records(network.get_chart(ticker, depth))
+        self.write(ticker, records)
+        self.depths[ticker] = depth
+        self.mark(ticker, target, records)
+        self.stats['full'] += 1
+
+    @staticmethod
+    def matches(stored: np.ndarray, fetched: np.ndarray) -> bool:
+        # Закрытия общих дней должны совпасть с сохранёнными; ни одного общего дня - тоже расхождение
+        common, stored_index, fetched_index = np.intersect1d(stored['day'], fetched['day'], return_indices=True)
+        return len(common) > 0 and \
+            np.allclose(stored['close'][stored_index], fetched['close'][fetched_index], rtol=1e-4, atol=0.005)
+
+    def mark(self, ticker: str, target: str, records: np.ndarray) -> bool:
+        # True - последний торговый день уже в файле, иначе следующий поход в сеть не раньше чем через retry_interval
+        if len(records) and records['day'][-1] >= np.datetime64(target, 'D').astype(int):
+            self.checked[ticker] = target
+            self.retry_at.pop(ticker, None)
+            return True
+        self.retry_at[ticker] = time.time() + retry_interval
+        return False
+
+    def window(self, ticker: str, days: int) -> np.ndarray:
+        # Последние days сессий, от старых к новым
+        self.update(ticker, days)
+        return self.load(ticker)[-days:]
+
+
+store = PriceStore()
@@ -0,0 +1,117 @@
+import argparse
+
+from multiprocessing import Pool
+from typing import Optional
+
+import aggregate
+import storage
+
+
+# Полный пересчёт агрегатов индустрий и секторов по тикерам.
+# python reaggregate.py - только показать расхождения, --write - записать пересчитанное.
+# Можно запускать при работающем боте: сектор, в котором за время пересчёта оценили тикер, пересчитывается заново
+max_attempts = 5
+
+
+def build_group(tickers: list[tuple[str, dict]]) -> dict:
+    group = aggregate.rebuild(data for _, data in tickers)
+    group['tickers'] = {'count': len(tickers), 'data': [ticker for ticker, _ in tickers]}
+    group['lastUpdate'] = max(data['lastUpdate'] for _, data in tickers)
+    return group
+
+
+def compare(name: str, old: Optional[dict], new: dict) -> list[str]:
+    if old is None:
+        return [f'{name}: missing']
+    diffs = []
+    if not aggregate.is_exact(old):
+        diffs.append(f'{name}: old acc/avg format')
+    if sorted(old['tickers']['data']) != sorted(new['tickers']['data']):
+        missing = sorted(set(new['tickers']['data']) - set(old['tickers']['data']))
+        extra = sorted(set(old['tickers']['data']) - set(new['tickers']['data']))
+        diffs.append(f'{name}: tickers missing {missing}, extra {extra}')
+    old_stats = aggregate.stats_of(old)
+    for stat_name, stat in aggregate.stats_of(new).items():
+        old_avg = old_stats.get(stat_name, {}).get('avg')
+        if old_avg != stat['avg']:
+            diffs.append(f'{name}.{stat_name}: avg {old_avg} -> {stat["avg"]}')
+    return diffs
+
+
+def init_worker(backend: str) -> None:
+    # Соединение SQLite, унаследованное от родителя через fork, в дочернем процессе использовать нельзя
+    storage.store = storage.open_store(backend)
+
+
+def sector_state(sector: str) -> dict[str, tuple[str, int]]:
+    return {ticker: (meta['industry'], meta['lastUpdate'])
+            for ticker, meta in storage.store.iter_meta() if meta['sector'] == sector}
+
+
+def rebuild_sector(sector: str) -> tuple[str, dict[str, Optional[dict]], Optional[dict], list[str],
+                                         dict[str, tuple[str, int]]]:
+    # Выполняется в отдельном процессе: один проход по тикерам сектора.
+    # None вместо агрегата - группа без тикеров, её записанный агрегат устарел и удаляется при --write.
+    # state - какие тикеры и версии вошли в пересчёт, перед записью сверяется с sector_state()
+    by_industry: dict[str, list[tuple[str, dict]]] = {}
+    all_tickers = []
+    state = {}
+    for industry, ticker, data in storage.store.iter_sector(sector):
+        by_industry.setdefault(industry, []).append((ticker, data))
+        all_tickers.append((ticker, data))
+        state[ticker] = (industry, data['lastUpdate'])
+
+    diffs = []
+    industries = {}
+    for industry, tickers in by_industry.items():
+        industries[industry] = build_group(tickers)
+        diffs += compare(f'{sector}/{industry}', storage.store.load_industry(sector, industry), industries[industry])
+    names = sorted(industries)
+    for industry in storage.store.stored_industries(sector):
+        if industry not in industries:
+            industries[industry] = None
+            diffs.append(f'{sector}/{industry}: stale aggregate without tickers')
+    old_sector = storage.store.load_sector(sector)
+    if not all_tickers:
+        if old_sector is not None:
+            diffs.append(f'{sector}: stale aggregate without tickers')
+        return sector, industries, None, diffs, state
+    sector_data = build_group(all_tickers)
+    sector_data['industries'] = {'count': len(names), 'data': names}
+    diffs += compare(sector, old_sector, sector_data)
+    old_names = sorted(old_sector.get('industries', {}).get('data', [])) if old_sector is not None else names
+    if old_names != names:
+        diffs.append(f'{sector}: industries {old_names} -> {names}')
+    return sector, industries, sector_data, diffs, state
+
+
+def reaggregate(write: bool = False, processes: Optional[int] = None) -> list[str]:
+    sectors = sorted({meta['sector'] for _, meta in storage.store.iter_meta()} | set(storage.store.stored_sectors()))
+    backend = 'tree' if isinstance(storage.store, storage.TreeStore) else 'sqlite'
+    report = []
+    with Pool(processes, initializer=init_worker, initargs=(backend,)) as pool:
+        for _ in range(max_attempts):
+            changed = []
+            for sector, industries, sector_data, diffs, state in pool.imap_unordered(rebuild_sector, sectors):
+                # Проверка и запись атомарны относительно оценок бота: BEGIN IMMEDIATE в SQLite,
+                # исключительная блокировка коммитов в дереве
+                if write and not storage.store.save_aggregates(sector, industries, sector_data,
+                                                               lambda: sector_state(sector) == state):
+                    changed.append(sector)
+                else:
+                    report += diffs
+            sectors = sorted(changed)
+            if not sectors:
+                break
+    report += [f'{sector}: tickers keep changing, not written' for sector in sectors]
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild industry and sector aggregates from ticker data')
+    parser.add_argument('--write', action='store_true', help='save rebuilt aggregates')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+    differences = reaggregate(args.write, args.processes)
+    print('\n'.join(differences) if differences else 'No differences')
+    print(f'{len(differences)} differences{", written" if args.write and differences else ""}')
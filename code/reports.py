@@ -0,0 +1,96 @@
+import hashlib
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Optional
+
+import filings
+import network
+import storage
+
+
+max_entries: int = 5000
+# Попадание не строит Company, а значит и не проверяет, вышел ли новый отчёт: это делает filings.calendar.
+# Срок действует всегда: reaggregate --write переписывает агрегаты из другого процесса, счётчики групп
+# здесь он не увеличивает, и такие изменения подхватываются только по истечении записи
+entry_ttl: float = network.cache_ttl['last_report']
+
+
+def fingerprint(report_config: dict) -> str:
+    return hashlib.sha1(json.dumps(report_config, sort_keys=True).encode()).hexdigest()
+
+
+class ReportCache:
+    # Готовые тексты отчётов по (тикер, язык, отпечаток настроек отчёта). Запись помечена версией данных:
+    # lastUpdate тикера и счётчики записей его индустрии и сектора (от них зависят средние и перцентили).
+    # Счётчики увеличиваются при каждой переоценке или удалении тикера в группе, так что устаревшая запись
+    # отбрасывается при следующем get
+    def __init__(self, _max_entries: int = max_entries, ttl: float = entry_ttl):
+        self.max_entries = _max_entries
+        self.ttl = ttl
+        # key -> {'version', 'created', 'name', 'report'}
+        self.entries: OrderedDict[tuple[str, str, str], dict] = OrderedDict()
+        self.group_versions: dict[tuple, int] = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0}
+
+    def version(self, meta: dict) -> tuple:
+        with self.lock:
+            return (meta['lastUpdate'],
+                    self.group_versions.get(('industry', meta['sector'], meta['industry']), 0),
+                    self.group_versions.get(('sector', meta['sector']), 0))
+
+    def touch(self, ticker: str, sector: str, industry: str, last_update: Optional[int] = None) -> Optional[tuple]:
+        # Данные тикера и агрегаты его групп переписаны -> новая версия для переоценённого тикера
+        with self.lock:
+            for group in (('industry', sector, industry), ('sector', sector)):
+                self.group_versions[group] = self.group_versions.get(group, 0) + 1
+            self.drop_ticker(ticker)
+            if last_update is None:
+                return None
+            return (last_update, self.group_versions[('industry', sector, industry)],
+                    self.group_versions[('sector', sector)])
+
+    def invalidate(self, ticker: str) -> None:
+        with self.lock:
+            self.drop_ticker(ticker)
+
+    def drop_ticker(self, ticker: str) -> None:
+        for key in [key for key in self.entries if key[0] == ticker]:
+            del self.entries[key]
+
+    def get(self, ticker: str, lang: str, report_config: dict) -> Optional[dict]:
+        # -> {'name', 'report'} или None
+        key = (ticker, lang, fingerprint(report_config))
+        with self.lock:
+            if key not in self.entries:
+                self.stats['misses'] += 1
+                return None
+        meta = storage.store.get_meta(ticker)
+        version = self.version(meta) if meta is not None else None
+        is_stale = filings.calendar.is_stale(ticker, meta['lastUpdate']) if meta is not None else True
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['version'] != version or is_stale or \
+                    time.time() - entry['created'] > self.ttl:
+                self.entries.pop(key, None)
+                self.stats['stale'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+
+    def put(self, ticker: str, lang: str, report_config: dict, version: tuple, name: str, report: str) -> None:
+        # version - снятая Company при чтении данных, см. Company.report_version
+        key = (ticker, lang, fingerprint(report_config))
+        with self.lock:
+            self.entries[key] = {'version': version, 'created': time.time(), 'name': name, 'report': report}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+
+cache = ReportCache()
@@ -0,0 +1,81 @@
+import operator
+import re
+
+from typing import Optional
+
+import numpy as np
+
+import peers
+
+
+# Фильтр по закэшированным тикерам без запросов к API, например:
+# peRatioTTM<15 and dividendYieldTTM>0.03 sort base_rate desc top 20
+default_limit: int = 10
+max_limit: int = 50
+
+operators = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne
+}
+condition_re = re.compile(r'^(\w+)\s*(<=|>=|==|!=|<|>|=)\s*(-?\d+(?:\.\d+)?)$')
+sort_re = re.compile(r'\s+sort\s+(\w+)(?:\s+(asc|desc))?', re.IGNORECASE)
+limit_re = re.compile(r'\s+top\s+(\d+)', re.IGNORECASE)
+
+
+def parse(text: str) -> tuple[list[tuple[str, str, float]], Optional[tuple[str, bool]], int]:
+    # -> условия (поле, оператор, число), сортировка (поле, по убыванию) и сколько строк вернуть
+    text = f' {text.strip()} '
+    limit = default_limit
+    match = limit_re.search(text)
+    if match:
+        limit = min(int(match.group(1)), max_limit)
+        text = text[:match.start()] + text[match.end():]
+    sort = None
+    match = sort_re.search(text)
+    if match:
+        sort = (match.group(1), (match.group(2) or 'asc').lower() == 'desc')
+        text = text[:match.start()] + text[match.end():]
+
+    conditions = []
+    for part in re.split(r'\s+and\s+', text.strip(), flags=re.IGNORECASE):
+        if not part:
+            continue
+        match = condition_re.match(part)
+        if match is None:
+            raise ValueError(f'Bad condition: {part}')
+        conditions.append((match.group(1), match.group(2), float(match.group(3))))
+    if not conditions and sort is None:
+        raise ValueError('Empty screen')
+    return conditions, sort, limit
+
+
+def screen(text: str, matrix: Optional[peers.IndicatorMatrix] = None) -> list[tuple[str, dict[str, float]]]:
+    # -> [(тикер, {поле: значение})], значения - по полям из условий и сортировки
+    conditions, sort, limit = parse(text)
+    matrix = matrix or peers.matrix.load()
+    fields = [field for field, _, _ in conditions] + ([sort[0]] if sort else [])
+    with matrix.lock:
+        for field in fields:
+            if field not in matrix.columns:
+                raise ValueError(f'Unknown field: {field}')
+        rows = np.fromiter(matrix.rows.values(), dtype=int, count=len(matrix.rows))
+        table = matrix.values[np.ix_(rows, [matrix.columns[field] for field in fields])]
+        names = [matrix.names[row] for row in rows]
+
+    # Тикер без значения поля не проходит ни одно условие по нему, в том числе '!=' (для NaN оно истинно)
+    mask = np.ones(len(rows), dtype=bool)
+    for i, (_, op, value) in enumerate(conditions):
+        with np.errstate(invalid='ignore'):
+            mask &= operators[op](table[:, i], value) & ~np.isnan(table[:, i])
+    selected = np.flatnonzero(mask)
+    if sort is not None:
+        key = table[selected, -1]
+        key = np.where(np.isnan(key), np.inf, -key if sort[1] else key)
+        selected = selected[np.argsort(key, kind='stable')]
+    selected = selected[:limit]
+    return [(names[i], {field: float(table[i, j]) for j, field in enumerate(fields)}) for i in selected]
@@ -0,0 +1,439 @@
+import json
+import sqlite3
+import sys
+import threading
+import uuid
+
+from contextlib import contextmanager
+from glob import escape as glob_escape, glob
+from os import fsync, path, mkdir, remove, replace
+from typing import Callable, Iterator, Optional, Union
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+data_path: str = '\\FinancialData/'
+# 'sqlite' - индексированная база, 'tree' - старое дерево json файлов
+storage_backend: str = 'sqlite'
+db_name: str = 'financial_data.sqlite3'
+
+
+@contextmanager
+def file_lock(lock_path: str, exclusive: bool = True):
+    # Блокировка между процессами. На Windows msvcrt не умеет разделяемую, там она всегда исключительная
+    with open(lock_path, 'a+b') as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        else:
+            while True:
+                try:
+                    file.seek(0)
+                    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK сдаётся через ~10 секунд, ждём дальше
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class TreeStore:
+    # FinancialData/<sector>/<industry>/<ticker>.json, _<industry>.json, _<sector>.json и общий all_tickers.json
+    # Запись: временный файл + атомарный rename, несколько файлов - через журнал коммита.
+    # Читатели видят либо старую, либо новую версию файла и блокировок не берут.
+    # file_locks разводят потоки одного процесса, commit_lock - коммиты и восстановление между процессами
+    file_locks: dict[str, threading.Lock] = {}
+    file_locks_guard = threading.Lock()
+
+    def __init__(self, _data_path: str = data_path):
+        self.data_path = _data_path
+        self.all_tickers_path = f'{_data_path}all_tickers.json'
+        self.commit_lock_path = f'{_data_path}.commit.lock'
+
+    def sector_path(self, sector: str) -> str:
+        return f'{self.data_path}{sector}/_{sector}.json'
+
+    def industry_path(self, sector: str, industry: str) -> str:
+        return f'{self.data_path}{sector}/{industry}/_{industry}.json'
+
+    def ticker_path(self, sector: str, industry: str, ticker: str) -> str:
+        return f'{self.data_path}{sector}/{industry}/{ticker}.json'
+
+    @staticmethod
+    def read(file_path: str) -> Optional[dict]:
+        if not path.exists(file_path):
+            return None
+        return json.load(open(file_path, 'rt', encoding='utf-8'))
+
+    @staticmethod
+    def write(file_path: str, data: dict) -> str:
+        # Пишет во временный файл рядом с целевым, переименование делает apply
+        tmp_path = f'{file_path}.tmp'
+        with open(tmp_path, 'wt', encoding='utf-8') as file:
+            json.dump(data, file)
+            file.flush()
+            fsync(file.fileno())
+        return tmp_path
+
+    @classmethod
+    @contextmanager
+    def locked(cls, *file_paths: str):
+        # Блокировки берутся в отсортированном порядке, чтобы два писателя не ждали друг друга по кругу
+        with cls.file_locks_guard:
+            locks = [cls.file_locks.setdefault(file_path, threading.Lock()) for file_path in sorted(set(file_paths))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @staticmethod
+    def apply(journal: dict[str, Optional[str]]) -> None:
+        for file_path, tmp_path in journal.items():
+            if tmp_path is None:
+                if path.exists(file_path):
+                    remove(file_path)
+            elif path.exists(tmp_path):
+                replace(tmp_path, file_path)
+
+    def commit(self, writes: dict[str, Optional[dict]], check: Optional[Callable[[], bool]] = None) -> bool:
+        # writes: путь -> данные, None - удалить файл. Вызывать под locked() по тем же путям.
+        # Коммиты разных процессов идут параллельно под разделяемой блокировкой, recover() ждёт их всех.
+        # check() выполняется под исключительной блокировкой, когда ни один процесс не коммитит: False - не писать
+        with file_lock(self.commit_lock_path, exclusive=check is not None):
+            if check is not None and not check():
+                return False
+            journal = {file_path: None if data is None else self.write(file_path, data)
+                       for file_path, data in writes.items()}
+            journal_path = f'{self.data_path}.commit-{uuid.uuid4().hex}.json'
+            # Атомарно появившийся журнал - точка коммита: после сбоя recover() доведёт его до конца
+            replace(self.write(journal_path, journal), journal_path)
+            self.apply(journal)
+            remove(journal_path)
+        return True
+
+    def recover(self) -> None:
+        # Один раз при старте бота. Под исключительной блокировкой ни один процесс не находится посреди коммита,
+        # так что каждый найденный журнал остался от упавшего писателя
+        with file_lock(self.commit_lock_path):
+            for journal_path in glob(f'{glob_escape(self.data_path)}.commit-*.json'):
+                journal = json.load(open(journal_path, 'rt', encoding='utf-8'))
+                self.apply(journal)
+                remove(journal_path)
+
+    def make_dirs(self, sector: str, industry: str) -> None:
+        if not path.exists(f'{self.data_path}{sector}'):
+            mkdir(f'{self.data_path}{sector}')
+        if not path.exists(f'{self.data_path}{sector}/{industry}'):
+            mkdir(f'{self.data_path}{sector}/{industry}')
+
+    def load_all_tickers(self) -> dict:
+        return self.read(self.all_tickers_path) or {'count': 0}
+
+    def get_meta(self, ticker: str) -> Optional[dict]:
+        return self.load_all_tickers().get(ticker) if ticker != 'count' else None
+
+    def count(self) -> int:
+        return self.load_all_tickers()['count']
+
+    def iter_meta(self) -> Iterator[tuple[str, dict]]:
+        for ticker, meta in self.load_all_tickers().items():
+            if ticker != 'count':
+                yield ticker, meta
+
+    def iter_tickers(self) -> Iterator[tuple[str, str, str, dict]]:
+        for ticker, meta in self.iter_meta():
+            data = self.load_ticker(meta['sector'], meta['industry'], ticker)
+            if data is not None:
+                yield meta['sector'], meta['industry'], ticker, data
+
+    def iter_sector(self, sector: str) -> Iterator[tuple[str, str, dict]]:
+        for ticker, meta in self.iter_meta():
+            if meta['sector'] == sector:
+                data = self.load_ticker(meta['sector'], meta['industry'], ticker)
+                if data is not None:
+                    yield meta['industry'], ticker, data
+
+    def iter_group(self, sector: str, industry: Optional[str] = None) -> Iterator[tuple[str, dict]]:
+        for ticker_industry, ticker, data in self.iter_sector(sector):
+            if industry in (None, ticker_industry):
+                yield ticker, data
+
+    def stored_sectors(self) -> list[str]:
+        # Сектора, для которых записан агрегат, в том числе уже без тикеров
+        return [path.basename(path.dirname(file_path))
+                for file_path in glob(f'{glob_escape(self.data_path)}*/_*.json')
+                if path.basename(file_path) == f'_{path.basename(path.dirname(file_path))}.json']
+
+    def stored_industries(self, sector: str) -> list[str]:
+        return [path.basename(path.dirname(file_path))
+                for file_path in glob(f'{glob_escape(f"{self.data_path}{sector}")}/*/_*.json')
+                if path.basename(file_path) == f'_{path.basename(path.dirname(file_path))}.json']
+
+    def load_ticker(self, sector: str, industry: str, ticker: str) -> Optional[dict]:
+        return self.read(self.ticker_path(sector, industry, ticker))
+
+    def load_industry(self, sector: str, industry: str) -> Optional[dict]:
+        return self.read(self.industry_path(sector, industry))
+
+    def load_sector(self, sector: str) -> Optional[dict]:
+        return self.read(self.sector_path(sector))
+
+    def save_ticker(self, sector: str, industry: str, ticker: str, data: dict) -> None:
+        ticker_path = self.ticker_path(sector, industry, ticker)
+        with self.locked(ticker_path):
+            self.commit({ticker_path: data})
+
+    def commit_estimate(self, sector: str, industry: str, ticker: str, meta: dict,
+                        estimate: Callable[[], tuple[dict, dict, dict]]) -> None:
+        # estimate() читает тикер и группы и возвращает их новые версии. Вызывается под теми же блокировками,
+        # что и запись, иначе параллельные оценки в одной группе затирают вклады друг друга
+        self.make_dirs(sector, industry)
+        file_paths = (self.ticker_path(sector, industry, ticker), self.industry_path(sector, industry),
+                      self.sector_path(sector))
+        with self.locked(self.all_tickers_path, *file_paths):
+            writes = dict(zip(file_paths, estimate()))
+            all_tickers = self.load_all_tickers()
+            if ticker not in all_tickers:
+                all_tickers['count'] = all_tickers['count'] + 1
+            all_tickers[ticker] = meta
+            writes[self.all_tickers_path] = all_tickers
+            self.commit(writes)
+
+    def save_aggregates(self, sector: str, industries: dict[str, Optional[dict]], sector_data: Optional[dict],
+                        check: Optional[Callable[[], bool]] = None) -> bool:
+        # None - группа осталась без тикеров, её агрегат удаляется. check() - см. commit()
+        writes = {self.industry_path(sector, industry): data for industry, data in industries.items()}
+        writes[self.sector_path(sector)] = sector_data
+        for industry, data in industries.items():
+            if data is not None:
+                self.make_dirs(sector, industry)
+        with self.locked(*writes):
+            return self.commit(writes, check)
+
+    def commit_removal(self, sector: str, industry: str, ticker: str,
+                       remove: Callable[[], tuple[dict, dict]]) -> None:
+        # remove() так же, как estimate() в commit_estimate, читает и пересчитывает группы под блокировками
+        ticker_path, industry_path, sector_path = \
+            self.ticker_path(sector, industry, ticker), self.industry_path(sector, industry), self.sector_path(sector)
+        with self.locked(self.all_tickers_path, ticker_path, industry_path, sector_path):
+            industry_data, sector_data = remove()
+            writes = {ticker_path: None, industry_path: industry_data, sector_path: sector_data}
+            all_tickers = self.load_all_tickers()
+            if ticker in all_tickers:
+                del all_tickers[ticker]
+                all_tickers['count'] = all_tickers['count'] - 1
+            writes[self.all_tickers_path] = all_tickers
+            self.commit(writes)
+
+
+class SqliteStore:
+    # Те же данные в одной базе: поиск тикера по индексу, а не чтение всего all_tickers.json
+    schema = '''
+        CREATE TABLE IF NOT EXISTS tickers (
+            ticker TEXT PRIMARY KEY,
+            sector TEXT NOT NULL,
+            industry TEXT NOT NULL,
+            version TEXT NOT NULL,
+            last_update INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tickers_by_group ON tickers (sector, industry);
+        CREATE TABLE IF NOT EXISTS industries (
+            sector TEXT NOT NULL,
+            industry TEXT NOT NULL,
+            last_update INTEGER,
+            data TEXT NOT NULL,
+            PRIMARY KEY (sector, industry)
+        );
+        CREATE TABLE IF NOT EXISTS sectors (
+            sector TEXT PRIMARY KEY,
+            last_update INTEGER,
+            data TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, db_path: str = f'{data_path}{db_name}'):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.connection.executescript(self.schema)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # Своё соединение на поток, WAL даёт читателям не ждать писателя
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def transaction(self) -> 'Transaction':
+        return Transaction(self.connection)
+
+    def get_meta(self, ticker: str) -> Optional[dict]:
+        row = self.connection.execute(
+            'SELECT version, sector, industry, last_update FROM tickers WHERE ticker = ?', (ticker,)).fetchone()
+        if row is None:
+            return None
+        return {'version': row[0], 'sector': row[1], 'industry': row[2], 'lastUpdate': row[3]}
+
+    def count(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM tickers').fetchone()[0]
+
+    def iter_meta(self) -> Iterator[tuple[str, dict]]:
+        for row in self.connection.execute('SELECT ticker, version, sector, industry, last_update FROM tickers'):
+            yield row[0], {'version': row[1], 'sector': row[2], 'industry': row[3], 'lastUpdate': row[4]}
+
+    def iter_tickers(self) -> Iterator[tuple[str, str, str, dict]]:
+        for row in self.connection.execute('SELECT sector, industry, ticker, data FROM tickers'):
+            yield row[0], row[1], row[2], json.loads(row[3])
+
+    def iter_sector(self, sector: str) -> Iterator[tuple[str, str, dict]]:
+        for row in self.connection.execute(
+                'SELECT industry, ticker, data FROM tickers WHERE sector = ?', (sector,)).fetchall():
+            yield row[0], row[1], json.loads(row[2])
+
+    def iter_group(self, sector: str, industry: Optional[str] = None) -> Iterator[tuple[str, dict]]:
+        if industry is None:
+            rows = self.connection.execute('SELECT ticker, data FROM tickers WHERE sector = ?', (sector,))
+        else:
+            rows = self.connection.execute(
+                'SELECT ticker, data FROM tickers WHERE sector = ? AND industry = ?', (sector, industry))
+        for row in rows.fetchall():
+            yield row[0], json.loads(row[1])
+
+    def stored_sectors(self) -> list[str]:
+        return [row[0] for row in self.connection.execute('SELECT sector FROM sectors')]
+
+    def stored_industries(self, sector: str) -> list[str]:
+        return [row[0] for row in self.connection.execute('SELECT industry FROM industries WHERE sector = ?', (sector,))]
+
+    def load_ticker(self, sector: str, industry: str, ticker: str) -> Optional[dict]:
+        row = self.connection.execute(
+            'SELECT data FROM tickers WHERE ticker = ? AND sector = ? AND industry = ?',
+            (ticker, sector, industry)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def load_industry(self, sector: str, industry: str) -> Optional[dict]:
+        row = self.connection.execute(
+            'SELECT data FROM industries WHERE sector = ? AND industry = ?', (sector, industry)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def load_sector(self, sector: str) -> Optional[dict]:
+        row = self.connection.execute('SELECT data FROM sectors WHERE sector = ?', (sector,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save_ticker(self, sector: str, industry: str, ticker: str, data: dict) -> None:
+        with self.transaction() as conn:
+            conn.execute('UPDATE tickers SET data = ? WHERE ticker = ?', (json.dumps(data), ticker))
+
+    @staticmethod
+    def put_estimate(conn: sqlite3.Connection, sector: str, industry: str, ticker: str, data: dict,
+                     industry_data: dict, sector_data: dict, meta: dict) -> None:
+        conn.execute('INSERT OR REPLACE INTO tickers VALUES (?, ?, ?, ?, ?, ?)',
+                     (ticker, sector, industry, meta['version'], meta['lastUpdate'], json.dumps(data)))
+        conn.execute('INSERT OR REPLACE INTO industries VALUES (?, ?, ?, ?)',
+                     (sector, industry, industry_data.get('lastUpdate'), json.dumps(industry_data)))
+        conn.execute('INSERT OR REPLACE INTO sectors VALUES (?, ?, ?)',
+                     (sector, sector_data.get('lastUpdate'), json.dumps(sector_data)))
+
+    def commit_estimate(self, sector: str, industry: str, ticker: str, meta: dict,
+                        estimate: Callable[[], tuple[dict, dict, dict]]) -> None:
+        # estimate() читает через то же соединение, то есть уже внутри BEGIN IMMEDIATE: между чтением групп
+        # и записью никто другой их не поменяет
+        with self.transaction() as conn:
+            data, industry_data, sector_data = estimate()
+            self.put_estimate(conn, sector, industry, ticker, data, industry_data, sector_data, meta)
+
+    def save_aggregates(self, sector: str, industries: dict[str, Optional[dict]], sector_data: Optional[dict],
+                        check: Optional[Callable[[], bool]] = None) -> bool:
+        # check() читает внутри той же BEGIN IMMEDIATE: False - тикеры изменились, ничего не пишем
+        with self.transaction() as conn:
+            if check is not None and not check():
+                return False
+            for industry, data in industries.items():
+                if data is None:
+                    conn.execute('DELETE FROM industries WHERE sector = ? AND industry = ?', (sector, industry))
+                else:
+                    conn.execute('INSERT OR REPLACE INTO industries VALUES (?, ?, ?, ?)',
+                                 (sector, industry, data.get('lastUpdate'), json.dumps(data)))
+            if sector_data is None:
+                conn.execute('DELETE FROM sectors WHERE sector = ?', (sector,))
+            else:
+                conn.execute('INSERT OR REPLACE INTO sectors VALUES (?, ?, ?)',
+                             (sector, sector_data.get('lastUpdate'), json.dumps(sector_data)))
+        return True
+
+    def commit_removal(self, sector: str, industry: str, ticker: str,
+                       remove: Callable[[], tuple[dict, dict]]) -> None:
+        with self.transaction() as conn:
+            industry_data, sector_data = remove()
+            conn.execute('INSERT OR REPLACE INTO industries VALUES (?, ?, ?, ?)',
+                         (sector, industry, industry_data.get('lastUpdate'), json.dumps(industry_data)))
+            conn.execute('INSERT OR REPLACE INTO sectors VALUES (?, ?, ?)',
+                         (sector, sector_data.get('lastUpdate'), json.dumps(sector_data)))
+            conn.execute('DELETE FROM tickers WHERE ticker = ?', (ticker,))
+
+
+class Transaction:
+    # BEGIN IMMEDIATE сразу берёт блокировку записи, так что писатели идут по очереди
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+def migrate(source: TreeStore, target: SqliteStore) -> int:
+    # Разовый перенос дерева json в базу одной транзакцией
+    count = 0
+    with target.transaction() as conn:
+        for ticker, meta in source.iter_meta():
+            sector, industry = meta['sector'], meta['industry']
+            data = source.load_ticker(sector, industry, ticker)
+            industry_data = source.load_industry(sector, industry)
+            sector_data = source.load_sector(sector)
+            if None in (data, industry_data, sector_data):
+                continue
+            target.put_estimate(conn, sector, industry, ticker, data, industry_data, sector_data, meta)
+            count += 1
+    return count
+
+
+def open_store(backend: str = storage_backend) -> Union[TreeStore, SqliteStore]:
+    tree = TreeStore()
+    if backend == 'tree':
+        return tree
+    db = SqliteStore()
+    if db.count() == 0 and path.exists(tree.all_tickers_path):
+        tree.recover()
+        migrate(tree, db)
+    return db
+
+
+store = open_store()
+
+
+if __name__ == '__main__':
+    # python storage.py migrate - перенести дерево FinancialData в базу
+    if sys.argv[1:] == ['migrate']:
+        TreeStore().recover()
+        print(f'Migrated {migrate(TreeStore(), SqliteStore())} tickers')
@@ -0,0 +1,39 @@
+import threading
+import time
+
+import network
+
+
+refresh_interval: int = 24 * 60 * 60
+
+
+class SymbolIndex:
+    # Множество известных тикеров, проверка за O(1) без запросов к API.
+    # Неизвестный символ проверяется через profile, ответ остаётся в кэше network и нужен дальше download_data
+    def __init__(self):
+        self.symbols: frozenset[str] = frozenset()
+        self.extra: set[str] = set()
+        self.loaded_at: float = 0.0
+        self.lock = threading.Lock()
+
+    def refresh(self) -> None:
+        symbols = frozenset(item['symbol'] for item in network.get_symbol_list() if item.get('symbol'))
+        with self.lock:
+            self.symbols = symbols
+            self.extra = set()
+            self.loaded_at = time.time()
+
+    def contains(self, ticker: str) -> bool:
+        return ticker in self.symbols or ticker in self.extra
+
+    def resolve(self, ticker: str) -> bool:
+        if self.contains(ticker):
+            return True
+        if network.check_ticker(ticker):
+            with self.lock:
+                self.extra.add(ticker)
+            return True
+        return False
+
+
+index = SymbolIndex()
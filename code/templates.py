@@ -0,0 +1,27 @@
+from functools import lru_cache
+
+
+# Строки из language.json с плейсхолдерами _, __, ___. Раньше каждая подстановка была str.replace(sign, value, 1)
+# по очереди; здесь та же цепочка замен прогоняется один раз при компиляции, с метками вместо значений,
+# и шаблон превращается в строку для str.format.
+# Значения, известные заранее (строки языка: подписи, динамика, n/a), подставляются сразу как есть, поэтому
+# '_' внутри них ведёт себя так же, как при последовательной замене. Остальные значения - числа и форматированные
+# суммы, в них нет '_' и они не пустые, так что результат совпадает с цепочкой replace байт-в-байт
+def mark(i: int) -> str:
+    return f'\x00{i}\x00'
+
+
+def escape(text: str) -> str:
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+@lru_cache(maxsize=1024)
+def compile_template(base: str, signs: tuple[str, ...], fixed: tuple[tuple[int, str], ...] = ()) -> str:
+    # fixed - пары (номер подстановки, строка), подстановка i без строки становится полем {i}
+    fixed_values = dict(fixed)
+    base = escape(base)
+    for i, sign in enumerate(signs):
+        base = base.replace(sign, escape(fixed_values[i]) if i in fixed_values else mark(i), 1)
+    for i in range(len(signs)):
+        base = base.replace(mark(i), f'{{{i}}}')
+    return base
@@ -0,0 +1,144 @@
+import copy
+import json
+import threading
+
+from collections import OrderedDict
+from os import fsync, path, replace
+from typing import Callable, Optional
+
+
+config_path: str = '\\Config/users/'
+max_resident: int = 10000
+
+
+def with_defaults(config: dict, template: dict) -> dict:
+    # Конфиг, записанный до появления новых настроек: недостающие ключи и элементы списков берутся из шаблона
+    for key, default in template.items():
+        if key not in config:
+            config[key] = copy.deepcopy(default)
+        elif isinstance(default, dict) and isinstance(config[key], dict):
+            with_defaults(config[key], default)
+        elif isinstance(default, list) and isinstance(config[key], list) and len(config[key]) < len(default):
+            config[key].extend(copy.deepcopy(default[len(config[key]):]))
+    return config
+
+
+class UserSettings:
+    # Типизированный доступ к конфигу пользователя, сам конфиг не меняется
+    def __init__(self, config: dict):
+        self.raw = config
+
+    @property
+    def language(self) -> str:
+        return self.raw['language']
+
+    @property
+    def work_mode(self) -> int:
+        return self.raw['work_mode']
+
+    @property
+    def report(self) -> dict:
+        return self.raw['report']
+
+    @property
+    def dynamics(self) -> int:
+        return self.raw['report']['dynamics']
+
+    @property
+    def value_type(self) -> int:
+        return self.raw['report']['value_type']
+
+    @property
+    def chart(self) -> dict:
+        return self.raw['chart']
+
+    @property
+    def show_chart(self) -> bool:
+        return self.raw['chart']['data'][0]
+
+    @property
+    def timeseries(self) -> int:
+        return self.raw['chart']['timeseries']
+
+
+class ConfigCache:
+    # Конфиги пользователей в памяти (LRU), попадание в кэш не трогает диск.
+    # write_behind=False - запись на диск сразу в update, иначе в flush() или при вытеснении
+    def __init__(self, template: dict, _max_resident: int = max_resident, write_behind: bool = False):
+        self.template = template
+        self.max_resident = _max_resident
+        self.write_behind = write_behind
+        # user_id -> (config, есть ли файл на диске)
+        self.configs: OrderedDict[int, tuple[dict, bool]] = OrderedDict()
+        self.dirty: set[int] = set()
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def file_path(user_id: int) -> str:
+        return f'{config_path}{str(user_id)}.json'
+
+    def read(self, user_id: int) -> tuple[dict, bool]:
+        file_path = self.file_path(user_id)
+        if path.exists(file_path):
+            return with_defaults(json.load(open(file_path, 'rt')), self.template), True
+        # Конфига нет: отдаём настройки по умолчанию, файл появится при первом update
+        return copy.deepcopy(self.template), False
+
+    def write(self, user_id: int, config: dict) -> None:
+        file_path = self.file_path(user_id)
+        with open(f'{file_path}.tmp', 'wt') as file:
+            json.dump(config, file)
+            file.flush()
+            fsync(file.fileno())
+        replace(f'{file_path}.tmp', file_path)
+
+    def load(self, user_id: int) -> tuple[dict, bool]:
+        with self.lock:
+            if user_id in self.configs:
+                self.configs.move_to_end(user_id)
+                return self.configs[user_id]
+            entry = self.read(user_id)
+            self.store(user_id, entry)
+            return entry
+
+    def store(self, user_id: int, entry: tuple[dict, bool]) -> None:
+        self.configs[user_id] = entry
+        self.configs.move_to_end(user_id)
+        while len(self.configs) > self.max_resident:
+            old_id, (old_config, _) = self.configs.popitem(last=False)
+            if old_id in self.dirty:
+                self.dirty.discard(old_id)
+                self.write(old_id, old_config)
+
+    def get(self, user_id: int) -> UserSettings:
+        return UserSettings(self.load(user_id)[0])
+
+    def exists(self, user_id: int) -> bool:
+        return self.load(user_id)[1]
+
+    def update(self, user_id: int, change: Callable[[dict], None]) -> UserSettings:
+        with self.lock:
+            config = copy.deepcopy(self.load(user_id)[0])
+            change(config)
+            # Прогоняем через json, чтобы в памяти был ровно тот конфиг, что прочитается с диска
+            config = json.loads(json.dumps(config))
+            self.store(user_id, (config, True))
+            if self.write_behind:
+                self.dirty.add(user_id)
+            else:
+                self.write(user_id, config)
+        return UserSettings(config)
+
+    def flush(self) -> None:
+        with self.lock:
+            for user_id in list(self.dirty):
+                self.write(user_id, self.configs[user_id][0])
+            self.dirty.clear()
+
+    def forget(self, user_id: Optional[int] = None) -> None:
+        with self.lock:
+            self.flush()
+            if user_id is None:
+                self.configs.clear()
+            else:
+                self.configs.pop(user_id, None)
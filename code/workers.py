@@ -0,0 +1,72 @@
+import threading
+import time
+import traceback
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+
+class BoundedPool:
+    # Пул потоков с ограниченной очередью: если заняты все воркеры и места в очереди, submit сразу отказывает
+    def __init__(self, workers: int, queue_size: int, name: str = 'worker', log_path: str = '\\log.txt'):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.log_path = log_path
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+
+    def submit(self, func: Callable, *args, **kwargs) -> Optional[Future]:
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            return None
+        with self.lock:
+            self.pending += 1
+        return self.executor.submit(self.run, func, *args, **kwargs)
+
+    def run(self, func: Callable, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            log_file = open(self.log_path, 'at', encoding='utf-8')
+            log_file.write(f'{time.strftime("%Y-%m-%d %X")}; worker error: {traceback.format_exc()}\n')
+            log_file.close()
+            raise
+        finally:
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+
+    @property
+    def depth(self) -> int:
+        # Задачи в работе и в очереди
+        return self.pending
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+class RateLimiter:
+    # Бюджет запросов к API: rate в минуту, накопленный за минуту запас можно потратить сразу.
+    # acquire резервирует запросы заранее и ждёт, пока бюджет не вернётся в плюс
+    def __init__(self, rate: float):
+        self.per_second = rate / 60.0
+        self.capacity = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count: int) -> float:
+        # -> сколько секунд пришлось ждать
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_second)
+            self.updated = now
+            self.tokens -= count
+            wait = -self.tokens / self.per_second if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait